@@ -0,0 +1,249 @@
+import os
+import time
+import argparse
+import resource
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import numpy as np
+import helpers as h
+import features as f
+import parallel as p
+
+STAGES = ['load', 'load_cached', 'build_graph', 'historical_target', 'historical_source',
+          'graph_target', 'graph_source', 'graph_feature_stage']
+
+
+def synthetic_ratings(n_edges, seed=0, n_users=None, reciprocity=0.35, neg_rate=0.1,
+                      n_rings=None, ring_size=8, start='2010-11-08', days=1900, self_rate=0.002):
+    """ Returns dataframe of synthetic bitcoin ratings shaped like the output
+    of helpers.load_bitcoin_edge_data, mimicking the OTC marketplace:
+    heavy tailed rating activity, reciprocated ratings and injected sybil
+    rings whose members rate each other within a few days before their
+    beneficiary is rated -10 by victims.
+    Input:
+        n_edges: int approximate number of ratings
+        seed: int
+        n_users: int, defaults to one user per 6 ratings as in OTC
+        reciprocity: float share of ratings answered by the ratee
+        neg_rate: float share of negative organic ratings
+        n_rings: int number of sybil rings, defaults to one per 2000 ratings
+        ring_size: int accounts per ring
+        start: first rating date
+        days: int span of the ratings
+        self_rate: float share of organic ratings a user gives themselves
+    Output:
+        dataframe
+    """
+    rng = np.random.default_rng(seed)
+    n_users = n_users or max(n_edges // 6, 10)
+    n_rings = n_edges // 2000 if n_rings is None else n_rings
+    start = np.datetime64(pd.Timestamp(start), 's')
+    span = days * 86400
+
+    # heavy tailed activity: a few traders give and receive most ratings
+    activity = rng.pareto(1.5, n_users) + 1
+    activity /= activity.sum()
+    n_organic = int(n_edges / (1 + reciprocity))
+    rater = rng.choice(n_users, n_organic, p=activity)
+    ratee = rng.choice(n_users, n_organic, p=activity)
+    ratee = np.where(rater == ratee, (ratee + 1) % n_users, ratee)
+    # a few self ratings, which the graph features count as a rater
+    ratee = np.where(rng.random(n_organic) < self_rate, rater, ratee)
+    # activity grows over time like the marketplace did
+    seconds = (np.sqrt(rng.random(n_organic)) * span).astype(np.int64)
+    rating = rng.choice([1, 2, 3, 4, 5, 10], n_organic, p=[.45, .2, .12, .08, .1, .05])
+    neg = rng.random(n_organic) < neg_rate
+    rating = np.where(neg, rng.choice([-10, -5, -1], n_organic, p=[.5, .2, .3]), rating)
+
+    # reciprocated ratings follow within a week
+    answered = rng.random(n_organic) < reciprocity
+    rec_seconds = seconds[answered] + rng.integers(60, 7 * 86400, answered.sum())
+    rec_rating = np.where(rating[answered] > 0, rating[answered], rng.choice([-10, -1], answered.sum()))
+    rater = np.r_[rater, ratee[answered]]
+    ratee = np.r_[ratee, rater[:n_organic][answered]]
+    seconds = np.r_[seconds, rec_seconds]
+    rating = np.r_[rating, rec_rating]
+
+    # sybil rings: fresh accounts densely rate each other and their beneficiary
+    ring_parts = []
+    for ring in range(n_rings):
+        members = n_users + ring * (ring_size + 1) + np.arange(ring_size + 1)
+        beneficiary = members[0]
+        t0 = rng.integers(0, span - 30 * 86400)
+        src, dst = np.meshgrid(members, members[1:])
+        src, dst = src.ravel(), dst.ravel()
+        keep = (src != dst) & (rng.random(len(src)) < 0.6)
+        src, dst = src[keep], dst[keep]
+        victims = rng.choice(n_users, 3, p=activity)
+        ring_parts.append(pd.DataFrame({
+            'rater': np.r_[src, victims],
+            'ratee': np.r_[dst, [beneficiary] * 3],
+            'rating': np.r_[np.full(len(src), 10), [-10] * 3],
+            'seconds': np.r_[t0 + rng.integers(0, 3 * 86400, len(src)),
+                             t0 + rng.integers(5 * 86400, 20 * 86400, 3)]}))
+
+    df = pd.DataFrame({'rater': rater + 1, 'ratee': ratee + 1, 'rating': rating, 'seconds': seconds})
+    if ring_parts:
+        rings = pd.concat(ring_parts, ignore_index=True)
+        rings[['rater', 'ratee']] += 1
+        df = pd.concat([df, rings], ignore_index=True)
+    df = df[df['seconds'] < span]
+
+    df = pd.DataFrame({'rater': df['rater'].to_numpy(np.int32),
+                       'ratee': df['ratee'].to_numpy(np.int32),
+                       'rating': df['rating'].to_numpy(np.int8),
+                       'date': start + df['seconds'].to_numpy().astype('timedelta64[s]')})
+    df['color'], df['penwidth'] = h._rating_style(df['rating'].values)
+    return df.sort_values('date', kind='stable').reset_index(drop=True)
+
+
+def write_snap_csv(bitcoin_df, filename):
+    """ Writes ratings in the gzipped SNAP csv format read by
+    helpers.load_bitcoin_edge_data (rater,ratee,rating,epoch seconds).
+    """
+    # the loader converts epochs to local time, so undo the utc offset of each
+    # quarter hour (approximate for the hour repeated when clocks go back)
+    local = bitcoin_df['date'].values.astype('datetime64[s]').astype(np.int64)
+    out = pd.DataFrame({'rater': bitcoin_df['rater'], 'ratee': bitcoin_df['ratee'],
+                        'rating': bitcoin_df['rating'], 'epoch': local - h._utc_offsets(local)})
+    out.to_csv(filename, header=False, index=False, compression='gzip')
+
+
+def run_stage(stage, bitcoin_df, filename):
+    """ Runs one pipeline stage on the ratings and returns its output.
+    The load stages read filename, written by prepare_stage.
+    """
+    if stage == 'load':
+        return h.load_bitcoin_edge_data(filename)
+    if stage == 'load_cached':
+        return h.load_bitcoin_edge_data(filename, cache=True)
+    if stage == 'build_graph':
+        return h.build_graph(bitcoin_df, rating_type='pos')
+    if stage in f.FEATURE_LISTS:
+        return f.feature_creation_batch(bitcoin_df, stage, f.FEATURE_LISTS[stage])
+    if stage == 'graph_feature_stage':
+        raw = np.random.default_rng(0).random((len(bitcoin_df), 28))
+        df_g = pd.DataFrame(raw, columns=f.GRAPH_TARGET_FEATURES + f.GRAPH_SOURCE_FEATURES)
+        return f.graph_feature_stage(pd.concat([bitcoin_df.reset_index(drop=True), df_g], axis=1))
+    raise ValueError(f"Unknown stage {stage}")
+
+
+def prepare_stage(stage, bitcoin_df, filename):
+    """ Does the untimed setup of a stage: writes the csv read by the load
+    stages and fills the cache read by load_cached.
+    """
+    if stage in ('load', 'load_cached'):
+        write_snap_csv(bitcoin_df, filename)
+    if stage == 'load_cached':
+        h.load_bitcoin_edge_data(filename, cache=True)
+
+
+def measure(stage, n_edges, seed=0):
+    """ Returns dict of wall time, throughput and peak resident memory of a
+    stage on synthetic ratings. Meant to run in a fresh process so the
+    peak memory belongs to this stage (and the synthetic ratings) alone.
+    """
+    bitcoin_df = synthetic_ratings(n_edges, seed)
+    with tempfile.TemporaryDirectory() as workdir:
+        filename = os.path.join(workdir, 'ratings.csv.gz')
+        prepare_stage(stage, bitcoin_df, filename)
+        start = time.perf_counter()
+        run_stage(stage, bitcoin_df, filename)
+        seconds = time.perf_counter() - start
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {'stage': stage,
+            'n_edges': len(bitcoin_df),
+            'seconds': seconds,
+            'rows_per_second': len(bitcoin_df) / seconds if seconds > 0 else np.inf,
+            'peak_rss_mb': peak_rss_mb}
+
+
+def benchmark(sizes, stages=STAGES, seed=0):
+    """ Returns dataframe of measurements of every stage at every size, each
+    run in its own process.
+    """
+    records = []
+    for n_edges in sizes:
+        for stage in stages:
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                records.append(pool.submit(measure, stage, n_edges, seed).result())
+            print(f"{stage:>20} {n_edges:>10,} edges {records[-1]['seconds']:10.3f}s "
+                  f"{records[-1]['rows_per_second']:12,.0f} rows/s {records[-1]['peak_rss_mb']:8.0f} MB",
+                  flush=True)
+    return pd.DataFrame(records)
+
+
+def scaling_exponents(results):
+    """ Returns the fitted exponent k of seconds ~ n_edges ** k for every
+    stage: 1 is linear, 2 quadratic.
+    """
+    exponents = {}
+    for stage, df in results.groupby('stage', sort=False):
+        if df['n_edges'].nunique() > 1:
+            exponents[stage] = np.polyfit(np.log(df['n_edges']), np.log(df['seconds']), 1)[0]
+    return pd.Series(exponents, name='exponent')
+
+
+def plot_scaling(results, filename):
+    """ Saves a log-log plot of seconds against size for every stage. """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(8, 5))
+    for stage, df in results.groupby('stage', sort=False):
+        ax.plot(df['n_edges'], df['seconds'], 'o-', label=stage)
+    ax.set_xscale('log')
+    ax.set_yscale('log')
+    ax.set_xlabel('Ratings')
+    ax.set_ylabel('Seconds')
+    ax.legend()
+    plt.tight_layout()
+    fig.savefig(filename)
+
+
+def check_equivalence(n_edges=2000, seed=0, atol=1e-9):
+    """ Returns dataframe comparing the optimised feature paths against the
+    per-row reference implementation (feature_creation_iteration with the
+    networkx graph metrics) on synthetic ratings.
+    """
+    bitcoin_df = synthetic_ratings(n_edges, seed)
+    records = []
+    for feature_type, feature_lst in f.FEATURE_LISTS.items():
+        reference = f.feature_creation_iteration(bitcoin_df, feature_type, feature_lst,
+                                                 method='networkx')[feature_lst].to_numpy()
+        candidates = {'batch': f.feature_creation_batch(bitcoin_df, feature_type, feature_lst),
+                      'parallel': p.parallel_feature_creation(bitcoin_df, feature_type, feature_lst,
+                                                              n_workers=2)}
+        for name, df in candidates.items():
+            max_error = np.abs(df[feature_lst].to_numpy() - reference).max()
+            records.append({'feature_type': feature_type, 'path': name,
+                            'max_abs_error': max_error, 'equal': max_error <= atol})
+    return pd.DataFrame(records)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the feature pipeline on synthetic ratings.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 30_000, 100_000])
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='csv file for the measurements')
+    parser.add_argument('--plot', help='png file for the scaling curves')
+    parser.add_argument('--check', type=int, metavar='N_EDGES',
+                        help='compare optimised paths against the reference on N_EDGES ratings')
+    args = parser.parse_args()
+
+    if args.check:
+        checks = check_equivalence(args.check, args.seed)
+        print(checks.to_string(index=False))
+        if not checks['equal'].all():
+            raise SystemExit("Optimised paths differ from the reference implementation")
+
+    results = benchmark(args.sizes, args.stages, args.seed)
+    print(scaling_exponents(results).to_string())
+    if args.output:
+        results.to_csv(args.output, index=False)
+    if args.plot:
+        plot_scaling(results, args.plot)
@@ -1,74 +1,256 @@
+from collections import OrderedDict
+
 import pandas as pd
 import numpy as np
 import networkx as nx
 import helpers as h
+import triads as t
+import profiling as pr
 
 
-def graph_user_features(bitcoin_df, user, rate_date):
-    """ Returns array containing predictive features for 
-    an individual bitcoin rating.
-    Input: 
-        bitcoin_df:  Dataframe containing bitcoin ratings as edges
+# Approximate mode: with method 'approx' the triad census among raters and
+# the betweenness are estimated by sampling, to a relative standard error of
+# APPROX_EPS within APPROX_TIME_BUDGET seconds per user; method 'auto' does
+# so only for users with more than APPROX_DEGREE raters. These are only the
+# defaults: the feature functions take approx_degree, eps and time_budget
+# arguments, which also reach the workers of parallel.py.
+APPROX_DEGREE = 1000
+APPROX_EPS = 0.05
+APPROX_TIME_BUDGET = 0.5
+
+def ego_graph_features(g, user, method='local', approx_degree=None, eps=None, time_budget=None):
+    """ Returns array containing the 14 graph features of a user,
+    computed on the reverse directed ego graph of the user in g.
+    Input:
+        g: positive ratings graph
         user: int
-        rate_date: date used for feature generation
+        method: string. 'local' computes the census and centrality directly
+                from the ego adjacency (triads.local_structure), 'approx'
+                estimates the costly parts of it, 'auto' estimates them only
+                above approx_degree raters, 'networkx' uses
+                networkx.triadic_census and centrality functions
+        approx_degree: int, defaults to APPROX_DEGREE
+        eps: float relative standard error target, defaults to APPROX_EPS
+        time_budget: seconds, defaults to APPROX_TIME_BUDGET
     Output:
         array
     """
-    g = h.build_graph(bitcoin_df, rating_type='pos', rating_date=rate_date)
     if user in g: 
+        if method in ('local', 'approx', 'auto'):
+            nodes, indptr, indices = t.ego_adjacency(g, user)
+            pr.annotate(ego_nodes=len(nodes), ego_edges=len(indices))
+            if len(nodes) <= 2:
+                return np.zeros(14)
+            if approx_degree is None:
+                approx_degree = APPROX_DEGREE
+            approx = method == 'approx' or (method == 'auto' and len(nodes) - 1 > approx_degree)
+            pr.annotate(approx=approx)
+            node_census, cluster_coef, neighbors_in, betweeness, excess_ratings_in = \
+                t.local_structure(indptr, indices, approx,
+                                  APPROX_EPS if eps is None else eps,
+                                  APPROX_TIME_BUDGET if time_budget is None else time_budget)
+            # a self rating makes the user one of its own raters, as in networkx
+            neighbors_in += user in g._pred[user]
+            return _graph_feature_array(node_census, cluster_coef, neighbors_in,
+                                        betweeness, excess_ratings_in)
         # reverse the graph so that ego graph picks up those who rated the node,
         # then reverse it again, so that metrics are based on orginal directed structure
-        ego_g = nx.ego_graph(nx.reverse_view(g), user, radius=1)
-        ego_g = nx.reverse_view(ego_g)
+        with pr.stage('nx.ego_graph'):
+            ego_g = nx.ego_graph(nx.reverse_view(g), user, radius=1)
+            ego_g = nx.reverse_view(ego_g)
+        pr.annotate(ego_nodes=len(ego_g), ego_edges=ego_g.number_of_edges())
         if len(ego_g) > 2:
-            node_census = nx.triadic_census(ego_g)
-            # fully connected traids:
-            triad_300 = node_census['300']
-            triad_210 = node_census['210']
-            triad_120 = node_census['120U'] + node_census['120D'] + node_census['120C']
-            triad_030T = node_census['030T']
-            triad_030C = node_census['030C']
-            # reciprocal but not fully connected:
-            triad_201 = node_census['201']
-            triad_111 = node_census['111U'] +node_census['111D']
-            triad_102 = node_census['102']
-            # no reciprocal ratings:
-            triad_021 = node_census['021U'] + node_census['021D'] + node_census['021C']
-            triad_all = sum(node_census.values())
-            cluster_coef = nx.clustering(ego_g, user)
+            with pr.stage('triadic_census'):
+                node_census = nx.triadic_census(ego_g)
+            with pr.stage('clustering'):
+                cluster_coef = nx.clustering(ego_g, user)
             neighbors_in = len(list(nx.reverse(ego_g).neighbors(user)))
-            betweeness = nx.betweenness_centrality(ego_g)[user]
-            excess_ratings_in = nx.in_degree_centrality(ego_g)[user] - nx.out_degree_centrality(ego_g)[user]
-            arr = np.array([triad_300,
-                            triad_210,
-                            triad_120,
-                            triad_030T,
-                            triad_030C,
-                            triad_201,
-                            triad_111,
-                            triad_102,
-                            triad_021,
-                            triad_all,
-                            cluster_coef,
-                            neighbors_in,
-                            betweeness,
-                            excess_ratings_in])
-            arr[np.isnan(arr)] = 0
-            return arr  
+            with pr.stage('betweenness_centrality'):
+                betweeness = nx.betweenness_centrality(ego_g)[user]
+            with pr.stage('degree_centrality'):
+                excess_ratings_in = nx.in_degree_centrality(ego_g)[user] - nx.out_degree_centrality(ego_g)[user]
+            return _graph_feature_array(node_census, cluster_coef, neighbors_in,
+                                        betweeness, excess_ratings_in)
     return np.zeros(14)
 
-def historical_source_user_features(bitcoin_df, user, rate_date):
+class EgoFeatureCache:
+    """ Bounded LRU cache of the 14 graph features of users, for a graph
+    that changes one edge at a time. The reverse ego graph of a user only
+    changes when an edge joins two of its nodes, so each graph change drops
+    just the cached users whose ego graph contains both ends of the edge.
+    Input:
+        maxsize: int number of users kept, least recently used dropped first
+        method: string (local/approx/auto/networkx), see ego_graph_features
+        approx_degree, eps, time_budget: approximate mode settings, see
+                ego_graph_features
+    """
+
+    def __init__(self, maxsize=4096, method='local', approx_degree=None, eps=None, time_budget=None):
+        self.maxsize = maxsize
+        self.method = method
+        self.approx_degree = approx_degree
+        self.eps = eps
+        self.time_budget = time_budget
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def features(self, g, user):
+        """ Returns the graph features of user in g, computed on a miss. """
+        arr = self.entries.get(user)
+        if arr is not None:
+            self.entries.move_to_end(user)
+            self.hits += 1
+            return arr
+        self.misses += 1
+        arr = ego_graph_features(g, user, self.method, self.approx_degree, self.eps, self.time_budget)
+        self.entries[user] = arr
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return arr
+
+    def invalidate_edge(self, g, rater, ratee):
+        """ Drops the users whose reverse ego graph holds both rater and
+        ratee: the users rated by both (or rated by one and being the other).
+        Call after adding the edge to g, or before removing it.
+        """
+        small, large = sorted((g.succ[rater], g.succ[ratee]), key=len)
+        touched = [user for user in small if user in large]
+        touched += [ratee, rater] if rater in g.succ[ratee] else [ratee]
+        for user in touched:
+            if self.entries.pop(user, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        """ Returns dict of hits, misses, hit rate, invalidations, evictions and size. """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions,
+                'size': len(self.entries)}
+
+def _graph_feature_array(node_census, cluster_coef, neighbors_in, betweeness, excess_ratings_in):
+    """ Returns the 14 graph features array from a triad census and
+    the centrality measures of the ego user.
+    """
+    # fully connected traids:
+    triad_300 = node_census['300']
+    triad_210 = node_census['210']
+    triad_120 = node_census['120U'] + node_census['120D'] + node_census['120C']
+    triad_030T = node_census['030T']
+    triad_030C = node_census['030C']
+    # reciprocal but not fully connected:
+    triad_201 = node_census['201']
+    triad_111 = node_census['111U'] +node_census['111D']
+    triad_102 = node_census['102']
+    # no reciprocal ratings:
+    triad_021 = node_census['021U'] + node_census['021D'] + node_census['021C']
+    triad_all = sum(node_census.values())
+    arr = np.array([triad_300,
+                    triad_210,
+                    triad_120,
+                    triad_030T,
+                    triad_030C,
+                    triad_201,
+                    triad_111,
+                    triad_102,
+                    triad_021,
+                    triad_all,
+                    cluster_coef,
+                    neighbors_in,
+                    betweeness,
+                    excess_ratings_in])
+    arr[np.isnan(arr)] = 0
+    return arr  
+
+def graph_user_features(bitcoin_df, user, rate_date, method='local', index=None, window=None,
+                        approx_degree=None, eps=None, time_budget=None):
+    """ Returns array containing predictive features for 
+    an individual bitcoin rating.
+    Input: 
+        bitcoin_df:  Dataframe containing bitcoin ratings as edges
+        user: int
+        rate_date: date used for feature generation
+        method: string (local/approx/auto/networkx), see ego_graph_features
+        index: optional helpers.RatingIndex of bitcoin_df, bitcoin_df may
+               then be None (e.g. for an index opened with store.open_store)
+        window: optional time span (e.g. '180D') limiting the graph to the
+                ratings made within window before rate_date
+        approx_degree, eps, time_budget: approximate mode settings, see
+                ego_graph_features
+    Output:
+        array
+    """
+    g = h.build_graph(bitcoin_df, rating_type='pos', rating_date=rate_date,
+                      edge_attr=False, index=index, window=window)
+    return ego_graph_features(g, user, method, approx_degree, eps, time_budget)
+
+def incremental_graph_features(bitcoin_df, user_type='target', method='local', g=None,
+                               window=None, start_date=None, cache=None,
+                               approx_degree=None, eps=None, time_budget=None):
+    """ Returns array containing the graph features of every bitcoin
+    rating, one row per rating in bitcoin_df order. Ratings are walked once
+    in date order and each is scored on the positive graph of all earlier
+    ratings, matching graph_user_features row by row.
+    Input:
+        bitcoin_df:  Dataframe containing bitcoin ratings as edges
+        user_type: string (target/source) selecting ratee or rater features
+        method: string (local/approx/auto/networkx), see ego_graph_features
+        g: positive graph of the ratings preceding bitcoin_df, if any
+        window: optional time span (e.g. '180D'). Each rating is scored on the
+                ratings within window before it, and expired ratings are
+                evicted as the walk advances
+        start_date: optional date. Ratings before it only seed the graph and
+                    their rows are left as zeros
+        cache: optional EgoFeatureCache (with the same method) to reuse
+               features of users whose ego graph is unchanged since their
+               last rating, and to read hit and miss counts from afterwards
+        approx_degree, eps, time_budget: approximate mode settings, see
+                ego_graph_features
+    Output:
+        array of shape (len(bitcoin_df), 14)
+    """
+    col = 'ratee' if user_type == 'target' else 'rater'
+    users = bitcoin_df[col].values
+    arr = np.zeros((len(bitcoin_df), 14))
+    if cache is None:
+        cache = EgoFeatureCache(method=method, approx_degree=approx_degree, eps=eps, time_budget=time_budget)
+    for _, positions, g in h.temporal_graph_iter(bitcoin_df, rating_type='pos', g=g,
+                                                 window=window, start_date=start_date,
+                                                 on_edge=cache.invalidate_edge):
+        for pos in positions:
+            user = users[pos]
+            with pr.stage('row', user=user):
+                arr[pos] = cache.features(g, user)
+    return arr
+
+@pr.profiled()
+def historical_source_user_features(bitcoin_df, user, rate_date, index=None):
     """ Returns array containing predictive features for 
     an individual bitcoin rating based on source of rating.
     Input: 
         bitcoin_df:  Dataframe containing bitcoin ratings as edges
         user: int
         rate_date: date used for feature generation
+        index: optional helpers.RatingIndex of bitcoin_df, bitcoin_df may
+               then be None (e.g. for an index opened with store.open_store)
     Output:
         array
     """
-    df = bitcoin_df.copy()
-    df_user = df[(df['rater']==user) & (df['date'] < rate_date)]
+    if index is not None:
+        df_user = h.user_data(bitcoin_df, user, 'source', 'all', rate_date, index=index)
+    else:
+        df_user = bitcoin_df[(bitcoin_df['rater']==user) & (bitcoin_df['date'] < rate_date)]
+        # the last rating is the latest by date, as with the index
+        df_user = df_user.sort_values('date', kind='stable')
 
     num_ratings_given = len(df_user)
     # check for no historical user data
@@ -86,18 +268,25 @@ def historical_source_user_features(bitcoin_df, user, rate_date):
     return arr
 
 
-def historical_target_user_features(bitcoin_df, user, rate_date):
+@pr.profiled()
+def historical_target_user_features(bitcoin_df, user, rate_date, index=None):
     """ Returns array containing predictive features for 
     an individual bitcoin rating.
     Input: 
         bitcoin_df:  Dataframe containing bitcoin ratings as edges
         user: int
         rate_date: date used for feature generation
+        index: optional helpers.RatingIndex of bitcoin_df, bitcoin_df may
+               then be None (e.g. for an index opened with store.open_store)
     Output:
         array
     """
-    df = bitcoin_df.copy()
-    df_user = df[(df['ratee']==user) & (df['date'] < rate_date)]
+    if index is not None:
+        df_user = h.user_data(bitcoin_df, user, 'target', 'all', rate_date, index=index)
+    else:
+        df_user = bitcoin_df[(bitcoin_df['ratee']==user) & (bitcoin_df['date'] < rate_date)]
+        # the last rating is the latest by date, as with the index
+        df_user = df_user.sort_values('date', kind='stable')
 
     num_ratings_received = len(df_user)
     # check for no historical user data
@@ -126,173 +315,394 @@ def historical_target_user_features(bitcoin_df, user, rate_date):
     arr[np.isnan(arr)] = 0
     return arr
 
-def feature_creation_iteration(bitcoin_df, feature_type, feature_lst):
+@pr.profiled()
+def historical_user_features_batch(bitcoin_df, user_type='target', prior=None):
+    """ Returns array containing the historical features of every bitcoin
+    rating, one row per rating in bitcoin_df order. Each row only sees the
+    user's ratings dated strictly before it, matching
+    historical_target_user_features / historical_source_user_features.
+    Input:
+        bitcoin_df:  Dataframe containing bitcoin ratings as edges
+        user_type: string (target/source) selecting ratee or rater history
+        prior: optional dataframe of the users' earlier ratings, as returned
+               by historical_user_state, for ratings dated after all of them
+    Output:
+        array of shape (len(bitcoin_df), 9) for target, (len(bitcoin_df), 4) for source
+    """
+    col = 'ratee' if user_type == 'target' else 'rater'
+    dates = bitcoin_df['date'].values
+    rating = bitcoin_df['rating'].values.astype(np.int64)
+    df = pd.DataFrame({'user': bitcoin_df[col].values,
+                       'date': dates,
+                       'rating': rating,
+                       'neg': (rating < 0).astype(np.int64),
+                       'pos': np.arange(len(bitcoin_df))})
+
+    # one group per (user, date): ratings sharing a date never see each other
+    grouped = df.groupby(['user', 'date'], sort=True)
+    group_id = grouped.ngroup().values
+    agg = grouped.agg(n=('rating', 'size'),
+                      neg=('neg', 'sum'),
+                      total=('rating', 'sum'),
+                      last_pos=('pos', 'max')).reset_index()
+    by_user = agg.groupby('user', sort=False)
+    prior_n = (by_user['n'].cumsum() - agg['n']).values
+    prior_neg = (by_user['neg'].cumsum() - agg['neg']).values
+    prior_total = (by_user['total'].cumsum() - agg['total']).values
+    first_date = by_user['date'].transform('first').values
+    # the last prior rating is the latest by date, then by frame order,
+    # i.e. the last row of the user's previous date group
+    prior_last_pos = by_user['last_pos'].shift(1, fill_value=0).values
+
+    num = prior_n[group_id].astype(float)
+    num_neg = prior_neg[group_id].astype(float)
+    total = prior_total[group_id].astype(float)
+    first = first_date[group_id]
+    last_pos = prior_last_pos[group_id]
+    last = dates[last_pos]
+    last_rating = rating[last_pos]
+    if prior is not None:
+        state = prior.reindex(df['user'].values)
+        known = state['n'].notna().values
+        only_prior = known & (num == 0)
+        num = num + state['n'].fillna(0).values
+        num_neg = num_neg + state['neg'].fillna(0).values
+        total = total + state['total'].fillna(0).values
+        first = np.where(known, state['first'].values, first)
+        last = np.where(only_prior, state['last'].values, last)
+        last_rating = np.where(only_prior, state['last_rating'].fillna(0).values, last_rating)
+
+    has_history = num > 0
+    one_day = np.timedelta64(1, 'D')
+    days_first = (dates - first) // one_day
+    days_last = (dates - last) // one_day
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if user_type == 'target':
+            arr = np.column_stack([num,
+                                   num_neg,
+                                   num - num_neg,
+                                   num_neg / num,
+                                   total,
+                                   total / num,
+                                   days_first,
+                                   days_last,
+                                   last_rating < 0])
+        else:
+            arr = np.column_stack([num,
+                                   total / num,
+                                   days_first,
+                                   days_last])
+    arr[~has_history] = 0
+    arr[np.isnan(arr)] = 0
+    return arr
+
+def historical_user_state(bitcoin_df, user_type='target', prior=None):
+    """ Returns dataframe of the rating history of every user after all
+    ratings in bitcoin_df, the aggregates historical_user_features_batch
+    needs to continue with later ratings.
+    Input:
+        bitcoin_df:  Dataframe containing bitcoin ratings as edges
+        user_type: string (target/source) selecting ratee or rater history
+        prior: optional state of the ratings preceding bitcoin_df, to extend
+    Output:
+        dataframe indexed on user with n, neg, total, first, last and
+        last_rating columns (last is the latest rating by date, ties broken
+        by frame order)
+    """
+    col = 'ratee' if user_type == 'target' else 'rater'
+    rating = bitcoin_df['rating'].values.astype(np.int64)
+    df = pd.DataFrame({'user': bitcoin_df[col].values,
+                       'date': bitcoin_df['date'].values,
+                       'rating': rating,
+                       'neg': (rating < 0).astype(np.int64)})
+    # date order, so that the last row of a user is their latest rating
+    df = df.sort_values('date', kind='stable')
+    state = df.groupby('user').agg(n=('rating', 'size'),
+                                   neg=('neg', 'sum'),
+                                   total=('rating', 'sum'),
+                                   first=('date', 'min'),
+                                   last=('date', 'last'),
+                                   last_rating=('rating', 'last'))
+    if prior is None:
+        return state
+    combined = prior.reindex(prior.index.union(state.index))
+    new = state.reindex(combined.index)
+    has_new = new['n'].notna()
+    for col in ('n', 'neg', 'total'):
+        combined[col] = combined[col].fillna(0) + new[col].fillna(0)
+    combined['first'] = combined['first'].fillna(new['first'])
+    for col in ('last', 'last_rating'):
+        combined[col] = combined[col].where(~has_new, new[col])
+    return combined.astype({'n': np.int64, 'neg': np.int64, 'total': np.int64, 'last_rating': np.int64})
+
+def iter_feature_rows(bitcoin_df, feature_type, method='local', index=None,
+                      approx_degree=None, eps=None, time_budget=None):
+    """ Yields the index label and feature array of every bitcoin rating,
+    computing each row from scratch with the per-rating feature functions.
+    Input: 
+        bitcoin_df:  dataframe containing bitcoin ratings as edges
+        feature_type: string (graph_target/graph_source/historical_target/historical_source)
+        method: string (local/approx/auto/networkx), see ego_graph_features
+        index: optional helpers.RatingIndex of bitcoin_df. With bitcoin_df
+               None, the ratings of the index are walked in date order
+        approx_degree, eps, time_budget: approximate mode settings, see
+                ego_graph_features
+    Output:
+        generator of (index, array)
+    """
+    rows_df = h.index_frame(index) if bitcoin_df is None else bitcoin_df
+    users = rows_df['ratee' if feature_type.endswith('target') else 'rater'].values
+    dates = rows_df['date']
+    for idx_df, user, rate_date in zip(rows_df.index, users, dates):
+        with pr.stage('row', user=user):
+            if feature_type.startswith('graph'):
+                arr = graph_user_features(bitcoin_df, user, rate_date, method, index,
+                                          approx_degree=approx_degree, eps=eps, time_budget=time_budget)
+            elif feature_type == 'historical_target':
+                arr = historical_target_user_features(bitcoin_df, user, rate_date, index)
+            else:
+                arr = historical_source_user_features(bitcoin_df, user, rate_date, index)
+        yield idx_df, arr
+
+@pr.profiled()
+def attach_features(bitcoin_df, arr, feature_lst):
+    """ Returns dataframe of the bitcoin ratings with the columns of a
+    feature matrix added as float columns in a single step.
+    Input: 
+        bitcoin_df:  dataframe containing bitcoin ratings as edges
+        arr: array of shape (len(bitcoin_df), len(feature_lst))
+        feature_lst: list of feature names, one per column of arr
+    """
+    features = pd.DataFrame(arr, index=bitcoin_df.index, columns=feature_lst)
+    return pd.concat([bitcoin_df.drop(columns=feature_lst, errors='ignore'), features], axis=1)
+
+def _check_feature_lst(feature_type, feature_lst):
+    """ Raises ValueError unless feature_lst names one column per feature
+    of the feature type.
+    """
+    width = len(FEATURE_LISTS[feature_type])
+    if len(feature_lst) != width:
+        raise ValueError(f"{feature_type} creates {width} features, "
+                         f"feature_lst names {len(feature_lst)}")
+
+def feature_creation_iteration(bitcoin_df, feature_type, feature_lst, sink=None, method='local',
+                               approx_degree=None, eps=None, time_budget=None):
     """ Returns datafame containing predictive features for 
     every bitcoin rating.
     Input: 
         bitcoin_df:  dataframe containing bitcoin ratings as edges
-        feature_type: string (graph/velocity/historical_target/historical_source)
+        feature_type: string (graph_target/graph_source/historical_target/historical_source)
         feature_lst: list of feature names to create    
+        sink: optional callable called with (index, array) for every rating.
+              When given, rows are streamed to it and nothing is returned
+        method: string (local/approx/auto/networkx), see ego_graph_features
+        approx_degree, eps, time_budget: approximate mode settings, see
+                ego_graph_features
     """
-    df = bitcoin_df.copy()
-    for idx_df, row in df.iterrows():
-        target = row['ratee']
-        source = row['rater']
-        rate_date = row['date']
-        if feature_type == 'graph_target':
-            arr = graph_user_features(df, target, rate_date)
-        elif feature_type == 'graph_source':
-            arr = graph_user_features(df, source, rate_date)
-        elif feature_type == 'historical_target':
-            arr = historical_target_user_features(df, target, rate_date)
-        elif feature_type == 'historical_source':
-            arr = historical_source_user_features(df, source, rate_date)
-        else:
-            print("Invalid Feature Type. Use: graph/velocity/historical")
-            return
-        for idx_lst, feature in enumerate(feature_lst):
-            df.at[(idx_df, feature)] = arr[idx_lst]
-    return df
+    if feature_type not in FEATURE_TYPES:
+        print("Invalid Feature Type. Use: graph/velocity/historical")
+        return
+    _check_feature_lst(feature_type, feature_lst)
+    rows = iter_feature_rows(bitcoin_df, feature_type, method,
+                             approx_degree=approx_degree, eps=eps, time_budget=time_budget)
+    if sink is not None:
+        for idx_df, arr in rows:
+            with pr.stage('write'):
+                sink(idx_df, arr)
+        return
+    matrix = np.zeros((len(bitcoin_df), len(feature_lst)))
+    for idx_row, (_, arr) in enumerate(rows):
+        with pr.stage('write'):
+            matrix[idx_row] = arr
+    return attach_features(bitcoin_df, matrix, feature_lst)
+
+def feature_creation_batch(bitcoin_df, feature_type, feature_lst, window=None, method='local',
+                           approx_degree=None, eps=None, time_budget=None):
+    """ Returns datafame containing predictive features for 
+    every bitcoin rating, computed in a single pass over the ratings
+    instead of once per row. Output matches feature_creation_iteration.
+    Input: 
+        bitcoin_df:  dataframe containing bitcoin ratings as edges
+        feature_type: string (graph_target/graph_source/historical_target/historical_source)
+        feature_lst: list of feature names to create    
+        window: optional time span (e.g. '180D') limiting graph features to
+                the ratings within window before each rating
+        method: string (local/approx/auto/networkx), see ego_graph_features
+        approx_degree, eps, time_budget: approximate mode settings, see
+                ego_graph_features
+    """
+    if feature_type in FEATURE_LISTS:
+        _check_feature_lst(feature_type, feature_lst)
+    if feature_type in ('graph_target', 'graph_source'):
+        arr = incremental_graph_features(bitcoin_df, feature_type.split('_')[1], method, window=window,
+                                         approx_degree=approx_degree, eps=eps, time_budget=time_budget)
+    elif feature_type == 'historical_target':
+        arr = historical_user_features_batch(bitcoin_df, 'target')
+    elif feature_type == 'historical_source':
+        arr = historical_user_features_batch(bitcoin_df, 'source')
+    else:
+        print("Invalid Feature Type. Use: graph/velocity/historical")
+        return
+    return attach_features(bitcoin_df, arr, feature_lst)
+
+# triad counts divided by neighbors_in, in output column order
+NORM_TRIADS = ['210', '120', '300', '030T', '201', '111', '102', '021', 'all']
+
+# (difference column, metric) pairs: target minus source of each metric
+DIFF_METRICS = ([('neighbors_in_diff', 'neighbors_in')] +
+                [(f'{triad}_diff', f'{triad}_norm') for triad in NORM_TRIADS[:-1]] +
+                [('triads_diff', 'all_norm'),
+                 ('betweeness_diff', 'betweeness'),
+                 ('excess_ratings_in_diff', 'excess_ratings_in'),
+                 ('cluster_coef_diff', 'cluster_coef')])
+
+def _normalized_triads(df_g, side):
+    """ Returns the neighbors_in column of one side (target/source) with
+    zeros replaced by ones, and its triad counts divided by it.
+    """
+    neighbors = df_g[f'neighbors_in_{side}'].to_numpy()
+    neighbors = np.where(neighbors == 0, 1, neighbors)
+    triads = df_g[[f'triad_{triad}_{side}' for triad in NORM_TRIADS]].to_numpy(dtype=float)
+    return neighbors, triads / neighbors[:, None]
+
+def _normalize_graph_metrics(df_g, side):
+    neighbors, norm = _normalized_triads(df_g, side)
+    df = df_g.drop(columns=[f'triad_{triad}_{side}' for triad in NORM_TRIADS])
+    df[f'neighbors_in_{side}'] = neighbors
+    norm = pd.DataFrame(norm, index=df_g.index, columns=[f'{triad}_norm_{side}' for triad in NORM_TRIADS])
+    return pd.concat([df, norm], axis=1)
 
 def normalize_source_graph_metrics(df_g):
-    df = df_g.copy()
-    df['neighbors_in_source'] = np.where(df['neighbors_in_source']==0, 1,df['neighbors_in_source'])
-    df['210_norm_source'] = df['triad_210_source']/df['neighbors_in_source']
-    df['120_norm_source'] = df['triad_120_source']/df['neighbors_in_source']
-    df['300_norm_source'] = df['triad_300_source']/df['neighbors_in_source']
-    df['030T_norm_source'] = df['triad_030T_source']/df['neighbors_in_source']
-    df['201_norm_source'] = df['triad_201_source']/df['neighbors_in_source']
-    df['111_norm_source'] = df['triad_111_source']/df['neighbors_in_source']
-    df['102_norm_source'] = df['triad_102_source']/df['neighbors_in_source']
-    df['021_norm_source'] = df['triad_021_source']/df['neighbors_in_source']
-    df['all_norm_source'] = df['triad_all_source']/df['neighbors_in_source']
-    drop_colls = ['triad_210_source',
-                  'triad_120_source',
-                  'triad_300_source',
-                  'triad_030T_source',
-                  'triad_201_source',
-                  'triad_111_source',
-                  'triad_102_source',
-                  'triad_021_source',
-                  'triad_all_source']
-    df.drop(drop_colls, inplace=True, axis=1)    
-    return df
+    return _normalize_graph_metrics(df_g, 'source')
     
 
 def normalize_target_graph_metrics(df_g):
     """ Called by notebook program to normalize the graph data
     """
-    df = df_g.copy()
-    df['neighbors_in_target'] = np.where(df['neighbors_in_target']==0, 1,df['neighbors_in_target'])
-    df['210_norm_target'] = df['triad_210_target']/df['neighbors_in_target']
-    df['120_norm_target'] = df['triad_120_target']/df['neighbors_in_target']
-    df['300_norm_target'] = df['triad_300_target']/df['neighbors_in_target']
-    df['030T_norm_target'] = df['triad_030T_target']/df['neighbors_in_target']
-    df['201_norm_target'] = df['triad_201_target']/df['neighbors_in_target']
-    df['111_norm_target'] = df['triad_111_target']/df['neighbors_in_target']
-    df['102_norm_target'] = df['triad_102_target']/df['neighbors_in_target']
-    df['021_norm_target'] = df['triad_021_target']/df['neighbors_in_target']
-    df['all_norm_target'] = df['triad_all_target']/df['neighbors_in_target']
-    drop_colls = ['triad_210_target',
-                  'triad_120_target',
-                  'triad_300_target',
-                  'triad_030T_target',
-                  'triad_201_target',
-                  'triad_111_target',
-                  'triad_102_target',
-                  'triad_021_target',
-                  'triad_all_target']
-    df.drop(drop_colls, inplace=True, axis=1)
-    return df
+    return _normalize_graph_metrics(df_g, 'target')
 
 def graph_metrics_source_target_difference(df_gg):
-    df = df_gg.copy()
-    df['neighbors_in_diff'] = df['neighbors_in_target'] - df['neighbors_in_source']
-    df['210_diff'] = df['210_norm_target'] - df['210_norm_source']
-    df['120_diff'] = df['120_norm_target'] - df['120_norm_source']
-    df['300_diff'] = df['300_norm_target'] - df['300_norm_source']
-    df['030T_diff'] = df['030T_norm_target'] - df['030T_norm_source']
-    df['201_diff'] = df['201_norm_target'] - df['201_norm_source']
-    df['111_diff'] = df['111_norm_target'] - df['111_norm_source']
-    df['102_diff'] = df['102_norm_target'] - df['102_norm_source']
-    df['021_diff'] = df['021_norm_target'] - df['021_norm_source']
-    df['triads_diff'] = df['all_norm_target'] - df['all_norm_source']
-    df['betweeness_diff'] = df['betweeness_target'] - df['betweeness_source']
-    df['excess_ratings_in_diff'] = df['excess_ratings_in_target'] - df['excess_ratings_in_source']
-    df['cluster_coef_diff'] = df['cluster_coef_target'] - df['cluster_coef_source']
-    drop_colls = ['neighbors_in_source',
-                  '210_norm_source',
-                  '120_norm_source',
-                  '300_norm_source',
-                  '030T_norm_source',
-                  '201_norm_source',
-                  '111_norm_source',
-                  '102_norm_source',
-                  '021_norm_source',
-                  'all_norm_source',
-                  'betweeness_source',
-                  'excess_ratings_in_source',
-                  'cluster_coef_source']
-    df.drop(drop_colls, inplace=True, axis=1)
-    return df
+    target = df_gg[[f'{metric}_target' for _, metric in DIFF_METRICS]].to_numpy(dtype=float)
+    source_cols = [f'{metric}_source' for _, metric in DIFF_METRICS]
+    diff = target - df_gg[source_cols].to_numpy(dtype=float)
+    diff = pd.DataFrame(diff, index=df_gg.index, columns=[name for name, _ in DIFF_METRICS])
+    return pd.concat([df_gg.drop(columns=source_cols), diff], axis=1)
+
+@pr.profiled()
+def graph_feature_stage(df_g):
+    """ Returns dataframe of model ready graph features from a dataframe
+    holding the raw target and source graph features of each rating (as
+    written by the graph_target and graph_source passes). Triad counts of
+    both sides are divided by their clipped neighbors_in counts in one
+    broadcast and all target minus source differences are taken as one
+    array subtraction. The output, column order included, matches
+    normalize_target_graph_metrics, normalize_source_graph_metrics and
+    graph_metrics_source_target_difference applied in turn.
+    Input:
+        df_g: dataframe with the GRAPH_TARGET_FEATURES and GRAPH_SOURCE_FEATURES columns
+    """
+    neighbors_target, norm_target = _normalized_triads(df_g, 'target')
+    neighbors_source, norm_source = _normalized_triads(df_g, 'source')
+    metrics = ['betweeness', 'excess_ratings_in', 'cluster_coef']
+    # columns laid out in DIFF_METRICS order for both sides
+    target = np.column_stack([neighbors_target, norm_target,
+                              df_g[[f'{m}_target' for m in metrics]].to_numpy(dtype=float)])
+    source = np.column_stack([neighbors_source, norm_source,
+                              df_g[[f'{m}_source' for m in metrics]].to_numpy(dtype=float)])
+    values = np.column_stack([df_g['triad_030C_target'].to_numpy(dtype=float),
+                              df_g['cluster_coef_target'].to_numpy(dtype=float),
+                              neighbors_target,
+                              df_g['betweeness_target'].to_numpy(dtype=float),
+                              df_g['excess_ratings_in_target'].to_numpy(dtype=float),
+                              norm_target,
+                              df_g['triad_030C_source'].to_numpy(dtype=float),
+                              target - source])
+    columns = (['triad_030C_target', 'cluster_coef_target', 'neighbors_in_target',
+                'betweeness_target', 'excess_ratings_in_target'] +
+               [f'{triad}_norm_target' for triad in NORM_TRIADS] +
+               ['triad_030C_source'] +
+               [name for name, _ in DIFF_METRICS])
+    graph_cols = set(GRAPH_TARGET_FEATURES) | set(GRAPH_SOURCE_FEATURES)
+    other_cols = [col for col in df_g.columns if col not in graph_cols]
+    features = pd.DataFrame(values, index=df_g.index, columns=columns)
+    # column order of the chained functions: input columns they keep stay in
+    # place, then the normalized target triads, then the differences
+    kept = [col for col in df_g.columns if col not in graph_cols or col in columns]
+    appended = [col for col in columns if col not in kept]
+    return pd.concat([df_g[other_cols], features], axis=1)[kept + appended]
+
+HISTORICAL_TARGET_FEATURES = [
+    'num_ratings_received',
+    'num_neg_received',
+    'num_pos_received',
+    'neg_ratings_pct',
+    'rating_received_sum',
+    'rating_received_avg',
+    'days_since_first_rating_target',
+    'days_since_last_rating_target',
+    'last_rating_neg']
+
+HISTORICAL_SOURCE_FEATURES = [
+    'num_ratings_given',
+    'rating_given_avg',
+    'days_since_first_rating_source',
+    'days_since_last_rating_source']
+
+GRAPH_TARGET_FEATURES = ['triad_300_target',
+                         'triad_210_target',
+                         'triad_120_target',
+                         'triad_030T_target',
+                         'triad_030C_target',
+                         'triad_201_target',
+                         'triad_111_target',
+                         'triad_102_target',
+                         'triad_021_target',
+                         'triad_all_target',
+                         'cluster_coef_target',
+                         'neighbors_in_target',
+                         'betweeness_target',
+                         'excess_ratings_in_target']
+
+GRAPH_SOURCE_FEATURES = ['triad_300_source',
+                         'triad_210_source',
+                         'triad_120_source',
+                         'triad_030T_source',
+                         'triad_030C_source',
+                         'triad_201_source',
+                         'triad_111_source',
+                         'triad_102_source',
+                         'triad_021_source',
+                         'triad_all_source',
+                         'cluster_coef_source',
+                         'neighbors_in_source',
+                         'betweeness_source',
+                         'excess_ratings_in_source']
+
+FEATURE_TYPES = ('graph_target', 'graph_source', 'historical_target', 'historical_source')
+
+FEATURE_LISTS = {'historical_target': HISTORICAL_TARGET_FEATURES,
+                 'historical_source': HISTORICAL_SOURCE_FEATURES,
+                 'graph_target': GRAPH_TARGET_FEATURES,
+                 'graph_source': GRAPH_SOURCE_FEATURES}
 
 if __name__ == '__main__':
 
     otc_df = h.load_bitcoin_edge_data('../data/soc-sign-bitcoinotc.csv.gz')
 
-    historical_target_features = [
-        'num_ratings_received',
-        'num_neg_received',
-        'num_pos_received',
-        'neg_ratings_pct',
-        'rating_received_sum',
-        'rating_received_avg',
-        'days_since_first_rating_target',
-        'days_since_last_rating_target',
-        'last_rating_neg']
-    # df_historical_target_features = feature_creation_iteration(otc_df, 'historical_target', historical_target_features)
-    # df_historical_target_features.to_csv('../data/historical_target_features.csv', index=False)
-
-    historical_source_features = [
-        'num_ratings_given',
-        'rating_given_avg',
-        'days_since_first_rating_source',
-        'days_since_last_rating_source']
-    # df_historical_source_features = feature_creation_iteration(otc_df, 'historical_source', historical_source_features)
-    # df_historical_source_features.to_csv('../data/historical_source_features.csv', index=False)
+    df_historical_target_features = feature_creation_batch(otc_df, 'historical_target', HISTORICAL_TARGET_FEATURES)
+    df_historical_target_features.to_csv('../data/historical_target_features.csv', index=False)
+
+    df_historical_source_features = feature_creation_batch(otc_df, 'historical_source', HISTORICAL_SOURCE_FEATURES)
+    df_historical_source_features.to_csv('../data/historical_source_features.csv', index=False)
 
     # Process graph data and write output to csv file
-    graph_target_features = ['triad_300_target',
-                            'triad_210_target',
-                            'triad_120_target',
-                            'triad_030T_target',
-                            'triad_030C_target',
-                            'triad_201_target',
-                            'triad_111_target',
-                            'triad_102_target',
-                            'triad_021_target',
-                            'triad_all_target',
-                            'cluster_coef_target',
-                            'neighbors_in_target',
-                            'betweeness_target',
-                            'excess_ratings_in_target']
-    df_graph_target_features = feature_creation_iteration(otc_df, 'graph_target', graph_target_features)
+    df_graph_target_features = feature_creation_batch(otc_df, 'graph_target', GRAPH_TARGET_FEATURES)
     df_graph_target_features.to_csv('../data/graph_target_features.csv', index=False)
 
-    graph_source_features = ['triad_300_source',
-                            'triad_210_source',
-                            'triad_120_source',
-                            'triad_030T_source',
-                            'triad_030C_source',
-                            'triad_201_source',
-                            'triad_111_source',
-                            'triad_102_source',
-                            'triad_021_source',
-                            'triad_all_source',
-                            'cluster_coef_source',
-                            'neighbors_source',
-                            'betweeness_source',
-                            'excess_ratings_in_source']
-    df_graph_source_features = feature_creation_iteration(otc_df, 'graph_source', graph_source_features)
+    df_graph_source_features = feature_creation_batch(otc_df, 'graph_source', GRAPH_SOURCE_FEATURES)
     df_graph_source_features.to_csv('../data/graph_source_features.csv', index=False)
-       
\ No newline at end of file
+
+    # Normalized and source/target difference graph features
+    df_graph_features = graph_feature_stage(
+        pd.concat([df_graph_target_features, df_graph_source_features[GRAPH_SOURCE_FEATURES]], axis=1))
+    df_graph_features.to_csv('../data/graph_features.csv', index=False)
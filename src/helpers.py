@@ -1,30 +1,206 @@
+import os
+import time
+import hashlib
+from collections import namedtuple
 import pandas as pd
 import numpy as np
-import datetime
 import networkx as nx
+import profiling as pr
 
-def load_bitcoin_edge_data(filename):
+@pr.profiled()
+def load_bitcoin_edge_data(filename, cache=False, cache_dir=None):
     """ Returns dataframe containing bitcoin data with default index and datetime field format 
     and fraud classification field based on negative rating.
     Input: 
         filename: csv file with gzip compression
+        cache: bool. Keep a feather copy of the parsed dataframe next to the
+               file (or in cache_dir) and load it instead of the csv while
+               the source file is unchanged. Requires pyarrow
+        cache_dir: directory for the cached copy
     Output:
-        df: dataframe
+        df: dataframe with int32 rater/ratee, int8 rating, categorical color
+            and uint8 penwidth columns
     """
+    if cache:
+        cache_file = _edge_data_cache_file(filename, cache_dir)
+        if os.path.exists(cache_file):
+            try:
+                return pd.read_feather(cache_file).set_index('index').rename_axis(None)
+            except (ImportError, OSError, ValueError):
+                # unreadable copy, parse the csv again and rewrite it
+                pass
+
     df = pd.read_csv(filename,  
                     compression='gzip', 
                     names=['rater','ratee','rating','date'],
-                    dtype={'rater': int, 'ratee': int, 'rating': int})
-    df['date'] = df['date'].apply(lambda d: datetime.datetime.fromtimestamp(d).strftime('%Y-%m-%d %H:%M:%S'))
-    df['date'] = pd.to_datetime(df['date'])
-    df['color'] = np.where(df['rating'] < 0, 'red', 'blue')
-    conditions  = [np.absolute(df['rating']) >= 8, np.absolute(df['rating']) >= 4, np.absolute(df['rating']) >= 2]
+                    dtype={'rater': np.int32, 'ratee': np.int32, 'rating': np.int8, 'date': float})
+    # epoch seconds to naive local time, truncated to whole seconds
+    epoch = np.floor(df['date'].values).astype(np.int64)
+    df['date'] = pd.to_datetime(epoch + _utc_offsets(epoch), unit='s')
+    df['color'], df['penwidth'] = _rating_style(df['rating'].values)
+    df = df.sort_values('date', kind='stable')
+
+    if cache:
+        _write_edge_data_cache(df, cache_file)
+    return df
+
+def _utc_offsets(epoch):
+    """ Returns array of the local utc offset in seconds at each int64 epoch
+    second. Utc offsets only change on quarter hour boundaries, so they are
+    looked up once per quarter hour.
+    """
+    quarters, inverse = np.unique(epoch // 900, return_inverse=True)
+    offsets = np.array([time.localtime(q * 900).tm_gmtoff for q in quarters.tolist()], dtype=np.int64)
+    return offsets[inverse.ravel()]
+
+def _rating_style(rating):
+    """ Returns the categorical color (red for negative ratings) and uint8
+    penwidth (1 to 4 by rating magnitude) used to draw rating edges.
+    """
+    color = pd.Categorical.from_codes((rating < 0).astype(np.int8), categories=['blue', 'red'])
+    conditions  = [np.absolute(rating) >= 8, np.absolute(rating) >= 4, np.absolute(rating) >= 2]
     choices     = [4, 3, 2]
-    df['penwidth'] = np.select(conditions, choices, default=1)
-    df = df.sort_values('date')
+    penwidth = np.select(conditions, choices, default=1).astype(np.uint8)
+    return color, penwidth
+
+def _write_edge_data_cache(df, cache_file):
+    """ Writes the cached copy of an edge data file under a temporary name
+    and renames it into place, so a failed write never leaves a truncated
+    copy under the cache key, then removes the copies of older versions of
+    the file. A copy that cannot be written is skipped.
+    """
+    tmp = cache_file + '.tmp'
+    try:
+        df.rename_axis('index').reset_index().to_feather(tmp)
+        os.replace(tmp, cache_file)
+    except (ImportError, OSError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return
+    cache_dir = os.path.dirname(cache_file)
+    prefix = os.path.basename(cache_file).rsplit('.', 2)[0] + '.'
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        # <basename>.<16 hex digits>.feather
+        stale = (name.startswith(prefix) and name.endswith('.feather') and
+                 len(name) == len(prefix) + 16 + len('.feather') and path != cache_file)
+        if stale:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def _edge_data_cache_file(filename, cache_dir=None):
+    """ Returns path of the cached copy of an edge data file, keyed on the
+    file's content hash, modification time and the local timezone used
+    for the date conversion.
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            digest.update(block)
+    digest.update(str(os.stat(filename).st_mtime_ns).encode())
+    digest.update(str(time.tzname).encode())
+    cache_dir = cache_dir or os.path.dirname(os.path.abspath(filename))
+    return os.path.join(cache_dir, f"{os.path.basename(filename)}.{digest.hexdigest()[:16]}.feather")
+
+RatingIndex = namedtuple('RatingIndex', ['order', 'date', 'rater', 'ratee', 'rating', 'users',
+                                         'rater_indptr', 'rater_pos', 'ratee_indptr', 'ratee_pos',
+                                         'labels'], defaults=[None])
+
+@pr.profiled()
+def build_rating_index(bitcoin_df):
+    """ Returns a RatingIndex over the bitcoin ratings: the date-sorted rater,
+    ratee, rating and date columns, plus for every user the positions of the
+    ratings they gave and received, in date order. Questions such as "all
+    positive ratings received by a user before a date" are then answered
+    with searchsorted slices instead of filtering a copy of the dataframe.
+    Input:
+        bitcoin_df: dataframe of bitcoin ratings activity
+    Output:
+        RatingIndex:
+            order: row position in bitcoin_df of each date-sorted rating
+            date, rater, ratee, rating: date-sorted columns
+            users: sorted array of user ids
+            rater_indptr, rater_pos: ratings given by users[i] are
+                rater_pos[rater_indptr[i]:rater_indptr[i + 1]]
+            ratee_indptr, ratee_pos: same for ratings received
+            labels: bitcoin_df index label of each date-sorted rating
+    """
+    order = np.argsort(bitcoin_df['date'].values, kind='stable')
+    date = bitcoin_df['date'].values[order]
+    rater = bitcoin_df['rater'].values[order]
+    ratee = bitcoin_df['ratee'].values[order]
+    rating = bitcoin_df['rating'].values[order]
+    users = np.union1d(rater, ratee)
+
+    def user_offsets(col):
+        ids = np.searchsorted(users, col)
+        pos = np.argsort(ids, kind='stable')
+        indptr = np.r_[0, np.cumsum(np.bincount(ids, minlength=len(users)))]
+        return indptr, pos
+
+    rater_indptr, rater_pos = user_offsets(rater)
+    ratee_indptr, ratee_pos = user_offsets(ratee)
+    return RatingIndex(order, date, rater, ratee, rating, users,
+                       rater_indptr, rater_pos, ratee_indptr, ratee_pos,
+                       bitcoin_df.index.values[order])
+
+def index_frame(index, pos=None):
+    """ Returns dataframe of the ratings at date-sorted positions of a
+    RatingIndex (all of them by default), with the columns and row labels of
+    the loaded dataframe. Lets an index opened from disk (see store.py) be
+    queried without the full dataframe in memory.
+    Input:
+        index: RatingIndex
+        pos: optional array of positions
+    """
+    if pos is None:
+        pos = slice(None)
+    df = pd.DataFrame({'rater': index.rater[pos],
+                       'ratee': index.ratee[pos],
+                       'rating': index.rating[pos],
+                       'date': index.date[pos]},
+                      index=(index.order if index.labels is None else index.labels)[pos])
+    df['color'], df['penwidth'] = _rating_style(df['rating'].values)
     return df
 
-def user_data(bitcoin_df, user, user_type='target', rating_type='pos',rating_date=''):
+def user_positions(index, user, user_type='target', rating_type='pos', rating_date=''):
+    """ Returns the date-sorted positions in a RatingIndex of a single
+    users ratings prior to rating_date, filtered as in user_data.
+    Input:
+        index: RatingIndex
+        user: int
+        user_type: str (target/source/all)
+        rating_type: str (pos/neg/all)
+        rating_date: date
+    """
+    i = np.searchsorted(index.users, user)
+    if i == len(index.users) or index.users[i] != user:
+        return np.array([], dtype=np.int64)
+    received = index.ratee_pos[index.ratee_indptr[i]:index.ratee_indptr[i + 1]]
+    given = index.rater_pos[index.rater_indptr[i]:index.rater_indptr[i + 1]]
+    if user_type == 'target':
+        pos = received
+    elif user_type == 'source':
+        pos = given
+    elif user_type == 'all':
+        pos = np.union1d(received, given)
+    else:
+        print("Invalid user type")
+        return np.array([], dtype=np.int64)
+
+    if rating_date != '':
+        # positions are date ordered, so the cutoff is a prefix
+        pos = pos[:np.searchsorted(index.date[pos], np.datetime64(pd.Timestamp(rating_date)))]
+    if rating_type == 'pos':
+        pos = pos[index.rating[pos] > 0]
+    elif rating_type == 'neg':
+        pos = pos[index.rating[pos] < 0]
+    return pos
+
+@pr.profiled()
+def user_data(bitcoin_df, user, user_type='target', rating_type='pos',rating_date='', index=None):
     """ Returns a dataframe of a single users transactions prior to max date.
         Data may be filtered on user type (rater/ratee/all) and rating type (pos/neg/all)
     Input:
@@ -33,30 +209,48 @@ def user_data(bitcoin_df, user, user_type='target', rating_type='pos',rating_dat
         user_type: str
         rating_type: str
         rating_date: date
+        index: optional RatingIndex of bitcoin_df, used to slice out the
+               users rows directly instead of scanning the whole dataframe.
+               bitcoin_df may then be None, e.g. for a store.open_store index
     """
-    df = bitcoin_df.copy()
-    if rating_date != '':
-        df = df[df['date'] < rating_date].sort_values('date')
-
-    # restrict ratings to pos or neg is specified as parameter
-    if rating_type == 'pos':
-        df = df[df['rating']>0]
-    elif rating_type == 'neg':
-        df = df[df['rating']<0]
+    if index is not None:
+        pos = user_positions(index, user, user_type, rating_type, rating_date)
+        if bitcoin_df is None:
+            return index_frame(index, pos)
+        return bitcoin_df.iloc[index.order[pos]]
 
+    mask = _rating_mask(bitcoin_df, rating_type, rating_date)
     if user_type == 'target':
-        df = df[df['ratee'] == user]
+        mask &= bitcoin_df['ratee'].values == user
     elif user_type == 'source':
-        df = df[df['rater'] == user]   
+        mask &= bitcoin_df['rater'].values == user
     elif user_type =='all':   
-        df = df[(df['ratee'] == user) | (df['rater'] == user)]
+        mask &= (bitcoin_df['ratee'].values == user) | (bitcoin_df['rater'].values == user)
     else:
         print("Invalid user type")
-    
+    df = bitcoin_df[mask]
+    if rating_date != '':
+        df = df.sort_values('date', kind='stable')
     return df
 
+def _rating_mask(bitcoin_df, rating_type='all', rating_date=''):
+    """ Returns boolean array selecting the ratings of a rating type
+    (pos/neg/all) made prior to rating_date.
+    """
+    mask = np.ones(len(bitcoin_df), dtype=bool)
+    if rating_date != '':
+        mask &= (bitcoin_df['date'] < rating_date).values
+    # restrict ratings to pos or neg is specified as parameter
+    if rating_type == 'pos':
+        mask &= bitcoin_df['rating'].values > 0
+    elif rating_type == 'neg':
+        mask &= bitcoin_df['rating'].values < 0
+    return mask
+
 
-def build_graph(bitcoin_df, user_lst=[], rating_type='all', rating_date=''):
+@pr.profiled()
+def build_graph(bitcoin_df, user_lst=[], rating_type='all', rating_date='', edge_attr=True, index=None,
+                window=None):
     """ Returns a graph object containing bitcoin data in range up to and including 
     date (pos ratings only). Edge attributes created for each column in 
     dataframe that is not a node (rater or ratee).
@@ -67,6 +261,14 @@ def build_graph(bitcoin_df, user_lst=[], rating_type='all', rating_date=''):
         rating_type: string. Include only positive ratings if 'pos', only
                      negative ratings if 'neg', otherwise include all rating values
         rating_date: date. Only include records occurring prior to this date
+        edge_attr:   True to copy every column onto the edges, a list of
+                     column names to copy only those, or False for a graph
+                     without edge attributes
+        index:       optional RatingIndex of bitcoin_df. The ratings before
+                     rating_date are then a prefix of the index, and
+                     bitcoin_df may be None
+        window:      optional time span (e.g. '180D'). Only include records
+                     occurring within window before rating_date
     Output:
         graph:      attributes defined in bitcoin_df
                     color of edges: 
@@ -78,25 +280,142 @@ def build_graph(bitcoin_df, user_lst=[], rating_type='all', rating_date=''):
                        3=rating of +/- [4,5,6,7],
                        4=rating of +/- [8,9,10],
     """
-    df = bitcoin_df.copy()
-    if rating_date != '':
-        df = df[(df['date'] < rating_date)].sort_values('date')
-
-    # restrict ratings to pos or neg is specified as parameter
-    if rating_type == 'pos':
-        df = df[df['rating']>0]
-    elif rating_type == 'neg':
-        df = df[df['rating']<0]
+    if index is not None:
+        start, stop = 0, len(index.date)
+        if rating_date != '':
+            rating_date = np.datetime64(pd.Timestamp(rating_date))
+            stop = np.searchsorted(index.date, rating_date)
+            if window is not None:
+                start = np.searchsorted(index.date, rating_date - pd.Timedelta(window).to_timedelta64())
+        pos = np.arange(start, stop)
+        if rating_type == 'pos':
+            pos = pos[index.rating[start:stop] > 0]
+        elif rating_type == 'neg':
+            pos = pos[index.rating[start:stop] < 0]
+        if len(user_lst) > 0:
+            pos = pos[np.isin(index.ratee[pos], user_lst) | np.isin(index.rater[pos], user_lst)]
+        if not edge_attr:
+            g = nx.DiGraph()
+            g.add_edges_from(zip(index.rater[pos].tolist(), index.ratee[pos].tolist()))
+            return g
+        df = index_frame(index, pos) if bitcoin_df is None else bitcoin_df.iloc[index.order[pos]]
+    else:
+        mask = _rating_mask(bitcoin_df, rating_type, rating_date)
+        if rating_date != '' and window is not None:
+            mask &= (bitcoin_df['date'] >= pd.Timestamp(rating_date) - pd.Timedelta(window)).values
+        df = bitcoin_df[mask]
+        if rating_date != '':
+            df = df.sort_values('date', kind='stable')
+        # if arguments include user list, restrict graph to just these users
+        if len(user_lst) > 0:
+            df = df[(df['ratee'].isin(user_lst)) | (df['rater'].isin(user_lst))]
 
-    # if arguments include user list, restrict graph to just these users
-    if len(user_lst) > 0:
-        df = df[(df['ratee'].isin(user_lst)) | (df['rater'].isin(user_lst))]
-        
     g = nx.from_pandas_edgelist(df, source='rater',
                                     target='ratee',
-                                    edge_attr=True,
+                                    edge_attr=edge_attr if edge_attr else None,
                                     create_using=nx.DiGraph())
     return g
 
+def _edges(rater, ratee, keep, start, stop):
+    """ Returns list of the (rater, ratee) python int pairs of the kept
+    ratings at positions start to stop.
+    """
+    return [edge for edge, kept in zip(zip(rater[start:stop].tolist(), ratee[start:stop].tolist()),
+                                       keep[start:stop].tolist()) if kept]
+
+def temporal_graph_iter(bitcoin_df, rating_type='pos', g=None, window=None, start_date=None,
+                        on_edge=None):
+    """ Walks the ratings once in date order and yields, for each distinct
+    rating date, the graph of all ratings made strictly before that date.
+    A single graph object is grown in place, so the graph yielded for a date
+    matches build_graph(bitcoin_df, rating_type=rating_type, rating_date=date,
+    window=window) without rebuilding it for every row.
+    Input:
+        bitcoin_df:  dataframe containing bitcoin ratings as edges
+        rating_type: string. Include only positive ratings if 'pos', only
+                     negative ratings if 'neg', otherwise include all rating values
+        g:           graph of the ratings preceding bitcoin_df to grow from.
+                     Defaults to an empty graph. Not supported with window,
+                     since the dates of its edges are unknown
+        window:      optional time span (e.g. '180D'). Ratings older than
+                     window before the current date are evicted as the walk
+                     advances, and users left without ratings are dropped, so
+                     the graph stays bounded by the ratings in one window
+        start_date:  optional date. Ratings dated before it only seed the
+                     graph and are not yielded
+        on_edge:     optional callable(g, rater, ratee) called after an edge is
+                     added to the graph and before one is removed, e.g.
+                     features.EgoFeatureCache.invalidate_edge
+    Output:
+        generator of (rate_date, positions, graph) where positions holds the
+        integer row positions in bitcoin_df rated at rate_date. The graph is
+        updated when the generator resumes, so copy it if it must be kept.
+    """
+    dates = bitcoin_df['date'].values
+    order = np.argsort(dates, kind='stable')
+    dates = dates[order]
+    # numpy columns, turned into python ints one date at a time, so a
+    # windowed walk only holds python objects for the ratings in its graph
+    rater = bitcoin_df['rater'].values[order]
+    ratee = bitcoin_df['ratee'].values[order]
+    rating = bitcoin_df['rating'].values[order]
+    if rating_type == 'pos':
+        keep = rating > 0
+    elif rating_type == 'neg':
+        keep = rating < 0
+    else:
+        keep = np.ones(len(rating), dtype=bool)
+
+    if len(dates) == 0:
+        return
+    # row ranges sharing a timestamp see the same graph
+    bounds = np.flatnonzero(dates[1:] != dates[:-1]) + 1
+    starts = np.r_[0, bounds]
+    stops = np.r_[bounds, len(dates)]
+    if start_date is not None:
+        start_date = np.datetime64(pd.Timestamp(start_date))
+
+    if g is None:
+        g = nx.DiGraph()
+    elif window is not None:
+        raise ValueError("A starting graph cannot be combined with a window")
+    if window is not None:
+        window = pd.Timedelta(window).to_timedelta64()
+        # number of live ratings behind each edge, so repeat ratings keep it
+        edge_count = {}
+        evicted = 0
+        # first rating still inside the window of each date
+        expires = np.searchsorted(dates, dates[starts] - window)
+
+    for step, (start, stop) in enumerate(zip(starts, stops)):
+        if window is not None:
+            expire = expires[step]
+            with pr.stage('graph_evict'):
+                for edge in _edges(rater, ratee, keep, evicted, expire):
+                    edge_count[edge] -= 1
+                    if edge_count[edge] == 0:
+                        del edge_count[edge]
+                        if on_edge is not None:
+                            on_edge(g, *edge)
+                        g.remove_edge(*edge)
+                        for node in set(edge):
+                            if g.degree(node) == 0:
+                                g.remove_node(node)
+            evicted = expire
+        if start_date is None or dates[start] >= start_date:
+            yield dates[start], order[start:stop], g
+        with pr.stage('graph_update'):
+            edges = _edges(rater, ratee, keep, start, stop)
+            if window is not None:
+                for edge in edges:
+                    edge_count[edge] = edge_count.get(edge, 0) + 1
+            if on_edge is None:
+                g.add_edges_from(edges)
+            else:
+                for edge in edges:
+                    if not g.has_edge(*edge):
+                        g.add_edge(*edge)
+                        on_edge(g, *edge)
+
 if __name__ == '__main__':
     pass
@@ -0,0 +1,358 @@
+import time
+import argparse
+from collections import namedtuple
+
+import pandas as pd
+import numpy as np
+import networkx as nx
+
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+plt.style.use('ggplot')
+
+import helpers as h
+import visualizations as v
+
+# Weekly rating counts, aggregated once over a helpers.RatingIndex:
+#   weeks: week ending dates (Sundays), as labelled by resample('W')
+#   counts: (len(weeks), 2) positive and negative counts of all ratings
+#   indptr: rows indptr[i]:indptr[i + 1] of user_week and user_counts hold
+#           the weeks in which index.users[i] received (or gave) ratings
+Timeline = namedtuple('Timeline', ['weeks', 'counts', 'indptr', 'user_week', 'user_counts', 'users'])
+
+
+def _week_ids(dates):
+    """ Returns Monday to Sunday week numbers of datetime64 dates. """
+    # 1970-01-01 was a Thursday, so day + 3 counts days from a Monday
+    return (dates.astype('datetime64[D]').astype(np.int64) + 3) // 7
+
+
+def build_timeline(index, user_type='target'):
+    """ Returns the Timeline of a RatingIndex, so that the weekly counts of
+    any user are later read off by slicing instead of resampling a copy of
+    the ratings.
+    Input:
+        index: helpers.RatingIndex
+        user_type: string (target/source), count ratings received or given
+    """
+    if user_type == 'target':
+        indptr, pos = index.ratee_indptr, index.ratee_pos
+    elif user_type == 'source':
+        indptr, pos = index.rater_indptr, index.rater_pos
+    else:
+        raise ValueError("Invalid user type. Use: target/source")
+    weeks = _week_ids(index.date)
+    first = weeks.min() if len(weeks) else 0
+    weeks -= first
+    n_weeks = int(weeks.max()) + 1 if len(weeks) else 0
+    negative = (index.rating < 0).astype(np.int64)
+    counts = np.bincount(weeks * 2 + negative, minlength=2 * n_weeks).reshape(n_weeks, 2)
+
+    # (user, week) keys of each user's ratings, counted by sign
+    user_ids = np.repeat(np.arange(len(index.users)), np.diff(indptr))
+    keys, inverse = np.unique(user_ids * n_weeks + weeks[pos], return_inverse=True)
+    user_counts = np.bincount(inverse * 2 + negative[pos], minlength=2 * len(keys)).reshape(len(keys), 2)
+    user_indptr = np.searchsorted(keys // max(n_weeks, 1), np.arange(len(index.users) + 1))
+    labels = np.datetime64('1970-01-01', 'D') + (np.arange(n_weeks) + first) * 7 + 3
+    return Timeline(labels.astype('datetime64[ns]'), counts, user_indptr,
+                    keys % max(n_weeks, 1), user_counts, index.users)
+
+
+def timeline_counts(timeline, user=None, start_date=None, stop_date=None):
+    """ Returns dataframe of weekly positive and negative rating counts,
+    indexed by week ending date, of all ratings or of one user.
+    Input:
+        timeline: Timeline
+        user: optional int
+        start_date, stop_date: optional dates limiting the weeks returned
+    """
+    if user is None:
+        counts = timeline.counts
+    else:
+        counts = np.zeros_like(timeline.counts)
+        i = np.searchsorted(timeline.users, user)
+        if i < len(timeline.users) and timeline.users[i] == user:
+            rows = slice(timeline.indptr[i], timeline.indptr[i + 1])
+            counts[timeline.user_week[rows]] = timeline.user_counts[rows]
+    start, stop = 0, len(timeline.weeks)
+    if start_date is not None:
+        start = np.searchsorted(timeline.weeks, np.datetime64(pd.Timestamp(start_date)))
+    if stop_date is not None:
+        # the week ending on or after stop_date holds it
+        stop = np.searchsorted(timeline.weeks, np.datetime64(pd.Timestamp(stop_date).normalize())) + 1
+    weeks = slice(start, stop)
+    return pd.DataFrame(counts[weeks], index=pd.DatetimeIndex(timeline.weeks[weeks]),
+                        columns=['positive', 'negative'])
+
+
+def _user_ids(index, users):
+    """ Returns sorted positions in index.users of the users present. """
+    users = np.atleast_1d(users)
+    if len(index.users) == 0:
+        return np.array([], dtype=np.int64)
+    ids = np.clip(np.searchsorted(index.users, users), 0, len(index.users) - 1)
+    return np.unique(ids[index.users[ids] == users])
+
+
+def _gather(indptr, pos, ids):
+    """ Returns the concatenated CSR rows pos[indptr[i]:indptr[i + 1]] of ids. """
+    starts = indptr[ids]
+    lengths = indptr[ids + 1] - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.array([], dtype=np.int64)
+    shift = np.repeat(starts - np.r_[0, np.cumsum(lengths)[:-1]], lengths)
+    return pos[shift + np.arange(total)]
+
+
+def _in_window(index, pos, start_date=None, stop_date=None, rating_type='all'):
+    """ Returns the positions rated within [start_date, stop_date) and of a
+    rating type (pos/neg/all).
+    """
+    keep = np.ones(len(pos), dtype=bool)
+    if start_date is not None:
+        keep &= index.date[pos] >= np.datetime64(pd.Timestamp(start_date))
+    if stop_date is not None:
+        keep &= index.date[pos] < np.datetime64(pd.Timestamp(stop_date))
+    if rating_type == 'pos':
+        keep &= index.rating[pos] > 0
+    elif rating_type == 'neg':
+        keep &= index.rating[pos] < 0
+    return pos[keep]
+
+
+def neighborhood_positions(index, users, hops=1, start_date=None, stop_date=None,
+                           direction='all', rating_type='all'):
+    """ Returns the users within hops ratings of the given users and the
+    ratings among them, looked up through the per-user offsets of a
+    RatingIndex, so the cost grows with the neighborhood rather than with
+    all ratings. Only ratings made within [start_date, stop_date) link users.
+    Input:
+        index: helpers.RatingIndex
+        users: int or list of ints
+        hops: int
+        start_date, stop_date: optional dates
+        direction: string. 'in' follows ratings received (the reverse ego
+                   graph of the graph features), 'out' ratings given and
+                   'all' both
+        rating_type: string (pos/neg/all)
+    Output:
+        nodes: array of user ids
+        hop: array of the hop distance of each node
+        pos: array of date-sorted positions of the ratings among nodes
+    """
+    hop = np.full(len(index.users), -1, dtype=np.int64)
+    frontier = _user_ids(index, users)
+    hop[frontier] = 0
+    for k in range(1, hops + 1):
+        if len(frontier) == 0:
+            break
+        others = []
+        if direction in ('in', 'all'):
+            pos = _in_window(index, _gather(index.ratee_indptr, index.ratee_pos, frontier),
+                             start_date, stop_date, rating_type)
+            others.append(index.rater[pos])
+        if direction in ('out', 'all'):
+            pos = _in_window(index, _gather(index.rater_indptr, index.rater_pos, frontier),
+                             start_date, stop_date, rating_type)
+            others.append(index.ratee[pos])
+        ids = np.searchsorted(index.users, np.concatenate(others))
+        frontier = np.unique(ids[hop[ids] < 0])
+        hop[frontier] = k
+
+    members = np.flatnonzero(hop >= 0)
+    # every rating among members is among the ratings its rater gave
+    pos = _in_window(index, _gather(index.rater_indptr, index.rater_pos, members),
+                     start_date, stop_date, rating_type)
+    pos = np.sort(pos[hop[np.searchsorted(index.users, index.ratee[pos])] >= 0])
+    return index.users[members], hop[members], pos
+
+
+def neighborhood_graph(index, users, hops=1, start_date=None, stop_date=None,
+                       direction='all', rating_type='all'):
+    """ Returns a graph object of the k-hop neighborhood of users, see
+    neighborhood_positions. Nodes carry their hop distance and edges the
+    rating, date, color and penwidth of the latest rating, as build_graph.
+    """
+    nodes, hop, pos = neighborhood_positions(index, users, hops, start_date, stop_date,
+                                             direction, rating_type)
+    g = nx.DiGraph()
+    g.add_nodes_from((node, {'hop': k}) for node, k in zip(nodes.tolist(), hop.tolist()))
+    df = h.index_frame(index, pos)
+    attrs = [{'rating': rating, 'date': date, 'color': color, 'penwidth': penwidth}
+             for rating, date, color, penwidth in zip(df['rating'].tolist(), df['date'].tolist(),
+                                                      df['color'].tolist(), df['penwidth'].tolist())]
+    g.add_edges_from(zip(df['rater'].tolist(), df['ratee'].tolist(), attrs))
+    return g
+
+
+def level_of_detail(g, focus, max_nodes=300, max_edges=2000, seed=0):
+    """ Returns a subgraph of g small enough to draw quickly. Nodes are kept
+    by hop distance and then by degree, so the focus users and their most
+    active neighbors stay. If too many edges remain, every negative rating
+    and every rating of a focus user is kept and the rest are sampled.
+    Input:
+        g: graph object from neighborhood_graph
+        focus: int or list of ints
+        max_nodes: int
+        max_edges: int
+        seed: int seed of the edge sample
+    Output:
+        subgraph, with the number of hidden nodes and edges in its graph attributes
+    """
+    focus = set(np.atleast_1d(focus).tolist())
+    nodes = list(g)
+    if len(nodes) > max_nodes:
+        degree = dict(g.degree())
+        nodes.sort(key=lambda n: (n not in focus, g.nodes[n].get('hop', 0), -degree[n]))
+        nodes = nodes[:max_nodes]
+    sub = g.subgraph(nodes)
+    edges = list(sub.edges(data=True))
+    if len(edges) > max_edges:
+        kept = [e[2].get('rating', 1) < 0 or e[0] in focus or e[1] in focus for e in edges]
+        keep = [e for e, k in zip(edges, kept) if k]
+        rest = [e for e, k in zip(edges, kept) if not k]
+        n_sample = max(max_edges - len(keep), 0)
+        if n_sample < len(rest):
+            chosen = np.random.default_rng(seed).choice(len(rest), n_sample, replace=False)
+            rest = [rest[i] for i in np.sort(chosen)]
+        edges = keep + rest
+    lod = nx.DiGraph()
+    lod.add_nodes_from(sub.nodes(data=True))
+    lod.add_edges_from(edges)
+    lod.graph.update(hidden_nodes=len(g) - len(lod),
+                     hidden_edges=g.number_of_edges() - lod.number_of_edges())
+    return lod
+
+
+def shell_positions(g, focus, seed=0):
+    """ Returns dict of node positions with the focus users at the center
+    and every other node on a ring of radius equal to its hop distance.
+    Ring order groups nodes that rate the same inner node, and costs
+    O(nodes + edges), unlike force directed layouts.
+    """
+    focus = list(np.atleast_1d(focus).tolist())
+    rings = {}
+    for node, k in g.nodes(data='hop', default=1):
+        rings.setdefault(0 if node in focus else max(k, 1), []).append(node)
+    positions = {}
+    angle_of = {}
+    rng = np.random.default_rng(seed)
+    for k in sorted(rings):
+        ring = rings[k]
+        if k == 0:
+            angles = np.linspace(0, 2 * np.pi, len(ring), endpoint=False)
+            radius = 0.0 if len(ring) == 1 else 0.3
+        else:
+            # place each node next to the inner neighbor it is linked to
+            anchor = [np.mean([angle_of[m] for m in nx.all_neighbors(g, n) if m in angle_of] or
+                              [rng.uniform(0, 2 * np.pi)]) for n in ring]
+            ring = [ring[i] for i in np.argsort(anchor, kind='stable')]
+            angles = np.linspace(0, 2 * np.pi, len(ring), endpoint=False)
+            radius = float(k)
+        for node, angle in zip(ring, angles):
+            angle_of[node] = angle
+            positions[node] = (radius * np.cos(angle), radius * np.sin(angle))
+    return positions
+
+
+def plot_neighborhood(ax, g, focus, max_nodes=300, max_edges=2000, labels=25, seed=0, title=None):
+    """ Plots the neighborhood of flagged users with matplotlib collections
+    rather than graphviz: edges blue for positive and red for negative
+    ratings with width by penwidth, nodes colored by hop distance, and the
+    focus and most connected users labelled. Large neighborhoods are first
+    reduced with level_of_detail.
+    Input:
+        ax: matplotlib axes
+        g: graph object from neighborhood_graph
+        focus: int or list of ints
+        max_nodes, max_edges, seed: see level_of_detail
+        labels: int number of nodes labelled besides the focus users
+        title: optional plot title
+    """
+    lod = level_of_detail(g, focus, max_nodes, max_edges, seed)
+    positions = shell_positions(lod, focus, seed)
+    segments = [(positions[a], positions[b]) for a, b in lod.edges()]
+    colors = [d.get('color', 'blue') for _, _, d in lod.edges(data=True)]
+    widths = [0.4 * d.get('penwidth', 1) for _, _, d in lod.edges(data=True)]
+    ax.add_collection(LineCollection(segments, colors=colors, linewidths=widths, alpha=0.5, zorder=1))
+
+    nodes = list(lod)
+    xy = np.array([positions[n] for n in nodes]).reshape(-1, 2)
+    hops = np.array([lod.nodes[n].get('hop', 1) for n in nodes])
+    ax.scatter(xy[:, 0], xy[:, 1], c=hops, cmap='viridis_r', s=12, zorder=2)
+    focus_set = set(np.atleast_1d(focus).tolist())
+    degree = dict(lod.degree())
+    labelled = [n for n in nodes if n in focus_set]
+    labelled += sorted((n for n in nodes if n not in focus_set), key=lambda n: -degree[n])[:labels]
+    for n in labelled:
+        ax.annotate(str(n), positions[n], fontsize=9 if n in focus_set else 7, zorder=3)
+    ax.set_aspect('equal')
+    ax.autoscale_view()
+    ax.grid(False)
+    ax.set_xticks([])
+    ax.set_yticks([])
+    hidden = lod.graph['hidden_nodes'], lod.graph['hidden_edges']
+    subtitle = f"{len(lod)} users, {lod.number_of_edges()} ratings"
+    if any(hidden):
+        subtitle += f" ({hidden[0]} users and {hidden[1]} ratings hidden)"
+    ax.set_title(subtitle if title is None else f"{title}\n{subtitle}")
+
+
+class InvestigationView:
+    """ Neighborhood and timeline views of flagged users, answered from a
+    RatingIndex and a Timeline that are built once.
+    Input:
+        bitcoin_df: dataframe of bitcoin ratings, may be None with an index
+        index: optional helpers.RatingIndex, e.g. from store.open_store
+    """
+
+    def __init__(self, bitcoin_df=None, index=None):
+        self.index = index if index is not None else h.build_rating_index(bitcoin_df)
+        self.timeline = build_timeline(self.index, 'target')
+
+    def neighborhood(self, users, hops=1, start_date=None, stop_date=None, direction='all',
+                     rating_type='all'):
+        """ Returns the graph object of the neighborhood of users, see neighborhood_positions. """
+        return neighborhood_graph(self.index, users, hops, start_date, stop_date, direction, rating_type)
+
+    def timeline_counts(self, user=None, start_date=None, stop_date=None):
+        """ Returns dataframe of weekly counts of the ratings a user received. """
+        return timeline_counts(self.timeline, user, start_date, stop_date)
+
+    def show(self, user, rate_date=None, window='365D', hops=1, direction='all', max_nodes=300,
+             max_edges=2000):
+        """ Plots the ratings a user received per week above their
+        neighborhood of the ratings made in window before rate_date.
+        Returns the figure.
+        """
+        stop_date = None if rate_date is None else pd.Timestamp(rate_date)
+        start_date = None if stop_date is None or window is None else stop_date - pd.Timedelta(window)
+        fig, (ax_time, ax_graph) = plt.subplots(2, 1, figsize=(10, 12), height_ratios=[1, 4])
+        v.plot_timeline(None, f"Ratings received by {user}", counts=self.timeline_counts(user), ax=ax_time)
+        for date in (start_date, stop_date):
+            if date is not None:
+                ax_time.axvline(date, c='k', lw=0.8, ls='--')
+        g = self.neighborhood(user, hops, start_date, stop_date, direction)
+        plot_neighborhood(ax_graph, g, user, max_nodes, max_edges,
+                          title=f"{hops}-hop neighborhood of {user}")
+        fig.tight_layout()
+        return fig
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Plot the investigation view of a user.')
+    parser.add_argument('user', type=int)
+    parser.add_argument('--data', default='../data/soc-sign-bitcoinotc.csv.gz')
+    parser.add_argument('--date', help='rating date, the neighborhood holds the ratings before it')
+    parser.add_argument('--window', default='365D')
+    parser.add_argument('--hops', type=int, default=1)
+    parser.add_argument('--direction', default='all', choices=['in', 'out', 'all'])
+    parser.add_argument('--output', default='investigation.png')
+    args = parser.parse_args()
+
+    view = InvestigationView(h.load_bitcoin_edge_data(args.data))
+    start_time = time.time()
+    view.show(args.user, args.date, args.window, args.hops, args.direction).savefig(args.output)
+    print(f"{(time.time() - start_time):.2f} seconds to render {args.output}")
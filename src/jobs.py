@@ -0,0 +1,240 @@
+import os
+import json
+import hashlib
+import argparse
+
+import pandas as pd
+import numpy as np
+import networkx as nx
+import helpers as h
+import features as f
+import parallel as p
+
+# A job directory holds, per feature type:
+#   manifest.json      chunk list, input fingerprint and current snapshot,
+#                      appended chunks also keep the fingerprint of their input
+#   chunk_NNNN.pkl     (row positions, ratings with their features) per chunk
+#   snapshot_NNNN.pkl  graph or per-user aggregates after the last chunk
+# Files are written to a temporary name and renamed, and the manifest is
+# written last, so a crash leaves the job at its last completed chunk.
+
+
+def ratings_fingerprint(bitcoin_df):
+    """ Returns sha1 hex digest of the rater, ratee, rating and date columns. """
+    digest = hashlib.sha1()
+    for col in ('rater', 'ratee', 'rating', 'date'):
+        digest.update(np.ascontiguousarray(bitcoin_df[col].values).tobytes())
+    return digest.hexdigest()
+
+
+def _atomic_pickle(obj, filename):
+    pd.to_pickle(obj, filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
+
+
+def _write_manifest(job_path, manifest):
+    filename = os.path.join(job_path, 'manifest.json')
+    with open(filename + '.tmp', 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+
+def read_manifest(job_dir, feature_type):
+    """ Returns the manifest dict of a feature job, None if it has not started. """
+    filename = os.path.join(job_dir, feature_type, 'manifest.json')
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as fh:
+        return json.load(fh)
+
+
+def _timestamp(date):
+    return None if date is None else pd.Timestamp(date).isoformat()
+
+
+def _snapshot(bitcoin_df, feature_type, prior=None):
+    """ Returns the state after the ratings in bitcoin_df: the positive
+    graph for graph features, the per-user aggregates for historical ones.
+    """
+    user_type = feature_type.split('_')[1]
+    if feature_type.startswith('graph'):
+        if prior is None:
+            prior = nx.DiGraph()
+        pos = bitcoin_df[bitcoin_df['rating'] > 0]
+        prior.add_edges_from(zip(pos['rater'].tolist(), pos['ratee'].tolist()))
+        return prior
+    return f.historical_user_state(bitcoin_df, user_type, prior)
+
+
+def _chunk_features(chunk_df, feature_type, state, method='local'):
+    """ Returns the features of the ratings in chunk_df computed from the
+    state of the earlier ratings, and the state after chunk_df. A graph
+    state is updated in place.
+    """
+    user_type = feature_type.split('_')[1]
+    if feature_type.startswith('graph'):
+        arr = f.incremental_graph_features(chunk_df, user_type, method, g=state)
+        return arr, state
+    arr = f.historical_user_features_batch(chunk_df, user_type, prior=state)
+    return arr, f.historical_user_state(chunk_df, user_type, prior=state)
+
+
+def run_feature_job(bitcoin_df, feature_type, job_dir, n_chunks=20, method=None):
+    """ Returns datafame containing predictive features for every bitcoin
+    rating, identical to features.feature_creation_batch, computed over
+    date-ordered chunks that are checkpointed to job_dir as they finish.
+    Calling it again with the same ratings resumes after the last completed
+    chunk, and the state after the last chunk is kept for append_feature_job.
+    Input:
+        bitcoin_df:  dataframe containing bitcoin ratings as edges, as
+                     loaded by helpers.load_bitcoin_edge_data
+        feature_type: string (graph_target/graph_source/historical_target/historical_source)
+        job_dir: directory of the checkpoints, one sub directory per feature type
+        n_chunks: int number of date ranges of a new job
+        method: string (local/approx/auto/networkx), see features.ego_graph_features.
+                Defaults to the method of the job being resumed, 'local' for
+                a new job. A resumed job cannot change its method
+    """
+    if feature_type not in f.FEATURE_LISTS:
+        raise ValueError("Invalid Feature Type. Use: graph_target/graph_source/historical_target/historical_source")
+    feature_lst = f.FEATURE_LISTS[feature_type]
+    job_path = os.path.join(job_dir, feature_type)
+    os.makedirs(job_path, exist_ok=True)
+
+    fingerprint = ratings_fingerprint(bitcoin_df)
+    manifest = read_manifest(job_dir, feature_type)
+    if manifest is None:
+        method = method or 'local'
+        chunks = [{'file': f'chunk_{i:04d}.pkl', 'start': _timestamp(start), 'stop': _timestamp(stop)}
+                  for i, (start, stop) in enumerate(p.date_partitions(bitcoin_df, n_chunks))]
+        manifest = {'feature_type': feature_type, 'method': method, 'fingerprint': fingerprint,
+                    'n_rows': len(bitcoin_df), 'chunks': chunks, 'snapshot': None,
+                    'last_date': _timestamp(bitcoin_df['date'].max()) if len(bitcoin_df) else None}
+        _write_manifest(job_path, manifest)
+    elif manifest['fingerprint'] != fingerprint:
+        raise ValueError(f"{job_path} holds a job for different ratings, use another job_dir")
+    elif method is not None and method != manifest['method']:
+        raise ValueError(f"{job_path} holds a job started with method {manifest['method']}, not {method}")
+    method = manifest['method']
+
+    dates = bitcoin_df['date'].values
+    state, state_stop = None, None
+    for chunk in manifest['chunks']:
+        filename = os.path.join(job_path, chunk['file'])
+        if os.path.exists(filename):
+            continue
+        start = pd.Timestamp(chunk['start'])
+        if state is None or state_stop != chunk['start']:
+            # resuming: rebuild the state of the ratings before the chunk
+            state = _snapshot(bitcoin_df[dates < start.to_datetime64()], feature_type)
+        in_chunk = dates >= start.to_datetime64()
+        if chunk['stop'] is not None:
+            in_chunk &= dates < pd.Timestamp(chunk['stop']).to_datetime64()
+        positions = np.flatnonzero(in_chunk)
+        chunk_df = bitcoin_df.iloc[positions]
+        arr, state = _chunk_features(chunk_df, feature_type, state, method)
+        _atomic_pickle((positions, f.attach_features(chunk_df, arr, feature_lst)), filename)
+        state_stop = chunk['stop']
+
+    if manifest['snapshot'] is None:
+        if state is None or state_stop is not None:
+            state = _snapshot(bitcoin_df, feature_type)
+        manifest['snapshot'] = 'snapshot_0000.pkl'
+        _atomic_pickle(state, os.path.join(job_path, manifest['snapshot']))
+        _write_manifest(job_path, manifest)
+    return read_feature_store(job_dir, feature_type)
+
+
+def append_feature_job(new_df, feature_type, job_dir, method=None):
+    """ Returns datafame of the features of new ratings, computed from the
+    snapshot of a finished feature job so that only the new rows are
+    processed, and adds them to the job's feature store. Appending ratings
+    that are already in the store returns their stored features, so an
+    interrupted run can be repeated.
+    Input:
+        new_df: dataframe of ratings dated after every rating of the job
+        feature_type: string (graph_target/graph_source/historical_target/historical_source)
+        job_dir: directory of a job completed by run_feature_job
+        method: string (local/approx/auto/networkx), defaults to the method of the job
+    """
+    manifest = read_manifest(job_dir, feature_type)
+    if manifest is None or manifest['snapshot'] is None:
+        raise ValueError(f"No completed {feature_type} job in {job_dir}, run run_feature_job first")
+    if len(new_df) == 0:
+        return f.attach_features(new_df, np.zeros((0, len(f.FEATURE_LISTS[feature_type]))),
+                                 f.FEATURE_LISTS[feature_type])
+    job_path = os.path.join(job_dir, feature_type)
+    fingerprint = ratings_fingerprint(new_df)
+    for chunk in manifest['chunks']:
+        if chunk.get('fingerprint') == fingerprint:
+            return pd.read_pickle(os.path.join(job_path, chunk['file']))[1]
+    last_date = pd.Timestamp(manifest['last_date']) if manifest['last_date'] else None
+    if last_date is not None and new_df['date'].min() <= last_date:
+        raise ValueError(f"New ratings must be dated after {last_date}, the last rating of the job")
+
+    state = pd.read_pickle(os.path.join(job_path, manifest['snapshot']))
+    arr, state = _chunk_features(new_df, feature_type, state, method or manifest['method'])
+    df_features = f.attach_features(new_df, arr, f.FEATURE_LISTS[feature_type])
+
+    n_chunk = len(manifest['chunks'])
+    positions = manifest['n_rows'] + np.arange(len(new_df))
+    chunk = {'file': f'chunk_{n_chunk:04d}.pkl', 'start': _timestamp(new_df['date'].min()), 'stop': None,
+             'fingerprint': fingerprint}
+    manifest['chunks'][-1]['stop'] = chunk['start']
+    _atomic_pickle((positions, df_features), os.path.join(job_path, chunk['file']))
+    snapshot = f'snapshot_{n_chunk:04d}.pkl'
+    _atomic_pickle(state, os.path.join(job_path, snapshot))
+
+    old_snapshot = manifest['snapshot']
+    manifest.update(chunks=manifest['chunks'] + [chunk], snapshot=snapshot,
+                    n_rows=manifest['n_rows'] + len(new_df),
+                    last_date=_timestamp(new_df['date'].max()))
+    _write_manifest(job_path, manifest)
+    if os.path.exists(os.path.join(job_path, old_snapshot)):
+        os.remove(os.path.join(job_path, old_snapshot))
+    return df_features
+
+
+def read_feature_store(job_dir, feature_type):
+    """ Returns dataframe of every completed chunk of a feature job, the
+    original ratings followed by the appended ones.
+    """
+    manifest = read_manifest(job_dir, feature_type)
+    if manifest is None:
+        return None
+    parts = []
+    for chunk in manifest['chunks']:
+        filename = os.path.join(job_dir, feature_type, chunk['file'])
+        if os.path.exists(filename):
+            parts.append(pd.read_pickle(filename))
+    if not parts:
+        return None
+    positions = np.concatenate([positions for positions, _ in parts])
+    df = pd.concat([df for _, df in parts])
+    return df.iloc[np.argsort(positions, kind='stable')]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Checkpointed feature generation with incremental append.')
+    parser.add_argument('--data', default='../data/soc-sign-bitcoinotc.csv.gz')
+    parser.add_argument('--job-dir', default='../data/feature_jobs')
+    parser.add_argument('--append', help='gzipped csv of new ratings to add to finished jobs')
+    parser.add_argument('--chunks', type=int, default=20)
+    parser.add_argument('--feature-types', nargs='+', default=list(f.FEATURE_LISTS), choices=list(f.FEATURE_LISTS))
+    args = parser.parse_args()
+
+    otc_df = h.load_bitcoin_edge_data(args.data)
+    new_df = h.load_bitcoin_edge_data(args.append) if args.append else None
+    stores = {}
+    for feature_type in args.feature_types:
+        stores[feature_type] = run_feature_job(otc_df, feature_type, args.job_dir, args.chunks)
+        if new_df is not None:
+            append_feature_job(new_df, feature_type, args.job_dir)
+            stores[feature_type] = read_feature_store(args.job_dir, feature_type)
+        stores[feature_type].to_csv(f'../data/{feature_type}_features.csv', index=False)
+
+    if 'graph_target' in stores and 'graph_source' in stores:
+        df_graph_features = f.graph_feature_stage(
+            pd.concat([stores['graph_target'], stores['graph_source'][f.GRAPH_SOURCE_FEATURES]], axis=1))
+        df_graph_features.to_csv('../data/graph_features.csv', index=False)
@@ -0,0 +1,173 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import numpy as np
+import helpers as h
+import features as f
+import store as s
+
+# ratings frame, or memory mapped store index, shared by every task of a
+# worker process, set once per worker
+_worker_df = None
+_worker_index = None
+
+
+def _init_worker(bitcoin_df, store_path=None):
+    global _worker_df, _worker_index
+    _worker_df = bitcoin_df
+    _worker_index = None if store_path is None else s.open_store(store_path)
+
+
+def date_partitions(bitcoin_df, n_chunks, index=None):
+    """ Returns list of (start_date, stop_date) ranges splitting the ratings
+    into roughly equal row counts. Ranges are cut on timestamp boundaries so
+    ratings sharing a date always land in the same chunk.
+    Input:
+        bitcoin_df: dataframe containing bitcoin ratings as edges
+        n_chunks: int
+        index: optional helpers.RatingIndex of the ratings, its dates are
+               already sorted and bitcoin_df may be None
+    Output:
+        list of (start_date, stop_date), stop_date is None for the last range
+    """
+    dates = np.sort(bitcoin_df['date'].values) if index is None else index.date
+    if len(dates) == 0:
+        return []
+    cuts = np.linspace(0, len(dates), n_chunks + 1)[1:-1].astype(int)
+    cut_dates = np.unique(dates[cuts])
+    cut_dates = cut_dates[cut_dates > dates[0]]
+    starts = [pd.Timestamp(d) for d in np.r_[dates[:1], cut_dates]]
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def _rows(bitcoin_df, index, pos):
+    """ Returns dataframe of the ratings at positions of bitcoin_df, or at
+    date-sorted positions of index when bitcoin_df is None.
+    """
+    return h.index_frame(index, pos) if bitcoin_df is None else bitcoin_df.iloc[pos]
+
+
+def chunk_features(bitcoin_df, feature_type, start_date, stop_date, method='local', window=None,
+                   approx_degree=None, eps=None, time_budget=None, index=None):
+    """ Returns the row positions of ratings dated in [start_date, stop_date)
+    and their features, using only the ratings dated before each row.
+    Input:
+        bitcoin_df: dataframe containing bitcoin ratings as edges
+        feature_type: string (graph_target/graph_source/historical_target/historical_source)
+        start_date: date
+        stop_date: date, None for no upper bound
+        method: string (local/approx/auto/networkx), see features.ego_graph_features
+        window: optional time span (e.g. '180D') for windowed graph features
+        approx_degree, eps, time_budget: approximate mode settings, see
+                features.ego_graph_features
+        index: optional helpers.RatingIndex of the ratings, e.g. a memory
+               mapped store.open_store index. bitcoin_df may then be None,
+               and only the rows of the chunk are turned into a dataframe
+    Output:
+        positions: array of row positions in bitcoin_df, or of date-sorted
+                   positions in index when bitcoin_df is None
+        arr: array of features, one row per position
+    """
+    approx = {'approx_degree': approx_degree, 'eps': eps, 'time_budget': time_budget}
+    if bitcoin_df is None:
+        dates = index.date
+    else:
+        dates, index = bitcoin_df['date'].values, None
+    before_stop = np.ones(len(dates), dtype=bool) if stop_date is None else dates < stop_date
+    positions = np.flatnonzero(before_stop & (dates >= start_date))
+    if feature_type in ('graph_target', 'graph_source') and window is not None:
+        # replay the window preceding the chunk to seed the graph and its evictions
+        seed = np.flatnonzero(before_stop & (dates >= start_date - pd.Timedelta(window)))
+        user_type = feature_type.split('_')[1]
+        arr = f.incremental_graph_features(_rows(bitcoin_df, index, seed), user_type, method,
+                                           window=window, start_date=start_date, **approx)
+        arr = arr[dates[seed] >= start_date]
+    elif feature_type in ('graph_target', 'graph_source'):
+        # one rebuild for the graph preceding the chunk, then grow it row by row
+        g = h.build_graph(bitcoin_df, rating_type='pos', rating_date=start_date, edge_attr=False,
+                          index=index)
+        user_type = feature_type.split('_')[1]
+        arr = f.incremental_graph_features(_rows(bitcoin_df, index, positions), user_type, method, g=g,
+                                           **approx)
+    elif feature_type in ('historical_target', 'historical_source'):
+        # seed the chunk with the aggregates of the ratings preceding it
+        user_type = feature_type.split('_')[1]
+        prior = f.historical_user_state(_rows(bitcoin_df, index, np.flatnonzero(dates < start_date)), user_type)
+        arr = f.historical_user_features_batch(_rows(bitcoin_df, index, positions), user_type, prior=prior)
+    else:
+        raise ValueError("Invalid Feature Type. Use: graph_target/graph_source/historical_target/historical_source")
+    return positions, arr
+
+
+def _worker_chunk_features(task):
+    return chunk_features(_worker_df, *task, index=_worker_index)
+
+
+def parallel_feature_creation(bitcoin_df, feature_type, feature_lst,
+                              n_workers=None, n_chunks=None, method='local', window=None, store=None,
+                              approx_degree=None, eps=None, time_budget=None):
+    """ Returns datafame containing predictive features for
+    every bitcoin rating, computed over date-partitioned chunks in a process
+    pool. The ratings are sent to each worker once, not with every chunk,
+    and results are put back in the original row order, so the output is
+    identical to features.feature_creation_batch. Historical features take
+    a single vectorized pass, so they are computed in the calling process.
+    Input:
+        bitcoin_df:  dataframe containing bitcoin ratings as edges
+        feature_type: string (graph_target/graph_source/historical_target/historical_source)
+        feature_lst: list of feature names to create
+        n_workers: int number of processes, defaults to the number of cpus
+        n_chunks: int number of date ranges, defaults to 4 per worker so
+                  the later, denser ranges do not leave workers idle
+        method: string (local/approx/auto/networkx), see features.ego_graph_features
+        window: optional time span (e.g. '180D') for windowed graph features
+        store: optional directory of a store.write_store copy of the ratings.
+               Workers then memory map it instead of receiving bitcoin_df
+               and build dataframes of their chunks only, and bitcoin_df may
+               be None to return the ratings in date order
+        approx_degree, eps, time_budget: approximate mode settings, see
+                features.ego_graph_features. They are sent with every chunk,
+                as workers do not see changes to the module defaults
+    """
+    if feature_type in f.FEATURE_LISTS:
+        f._check_feature_lst(feature_type, feature_lst)
+    n_workers = n_workers or os.cpu_count() or 1
+    n_chunks = n_chunks or 4 * n_workers
+    index = None if store is None else s.open_store(store)
+    tasks = [(feature_type, start, stop, method, window, approx_degree, eps, time_budget)
+             for start, stop in date_partitions(bitcoin_df, n_chunks, index=index)]
+    # store positions are date ordered, map them back to bitcoin_df rows
+    rows = None if index is None or bitcoin_df is None else index.order
+
+    arr = np.zeros((len(index.date) if bitcoin_df is None else len(bitcoin_df), len(feature_lst)))
+    if feature_type in ('historical_target', 'historical_source'):
+        # a single pass over the ratings, cheaper than any split of it
+        user_type = feature_type.split('_')[1]
+        if bitcoin_df is None:
+            bitcoin_df = h.index_frame(index)
+        arr = f.historical_user_features_batch(bitcoin_df, user_type)
+    elif n_workers == 1:
+        results = (chunk_features(bitcoin_df if index is None else None, *task, index=index)
+                   for task in tasks)
+        for positions, chunk_arr in results:
+            arr[positions if rows is None else rows[positions]] = chunk_arr
+    else:
+        initargs = (bitcoin_df,) if store is None else (None, store)
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 initializer=_init_worker,
+                                 initargs=initargs) as pool:
+            # later chunks hold the largest graphs, so start them first
+            for positions, chunk_arr in pool.map(_worker_chunk_features, tasks[::-1]):
+                arr[positions if rows is None else rows[positions]] = chunk_arr
+
+    return f.attach_features(h.index_frame(index) if bitcoin_df is None else bitcoin_df, arr, feature_lst)
+
+
+if __name__ == '__main__':
+
+    otc_df = h.load_bitcoin_edge_data('../data/soc-sign-bitcoinotc.csv.gz')
+
+    for feature_type, feature_lst in f.FEATURE_LISTS.items():
+        df_features = parallel_feature_creation(otc_df, feature_type, feature_lst)
+        df_features.to_csv(f'../data/{feature_type}_features.csv', index=False)
@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import argparse
+import functools
+import threading
+from contextlib import contextmanager, nullcontext
+
+import pandas as pd
+import numpy as np
+
+# active Profiler, None while profiling is disabled
+_profiler = None
+_NULL = nullcontext()
+
+
+class _Span:
+    __slots__ = ('profiler', 'name', 'args', 'start', 'child')
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.child = 0
+        self.profiler._stack.append(self)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        profiler = self.profiler
+        profiler._stack.pop()
+        dur = end - self.start
+        if profiler._stack:
+            profiler._stack[-1].child += dur
+        profiler.events.append((self.name, self.start, dur, dur - self.child, self.args))
+        return False
+
+
+class Profiler:
+    """ Records the wall time of named stages as nested spans. Each event
+    holds (name, start ns, duration ns, self ns, args), where self time
+    excludes the nested stages and args holds annotations such as the user
+    and ego graph size of a row.
+    """
+
+    def __init__(self):
+        self.events = []
+        self._stack = []
+        self.pid = os.getpid()
+        self.tid = threading.get_ident()
+
+    def stage(self, name, **args):
+        return _Span(self, name, args)
+
+    def annotate(self, **args):
+        if self._stack:
+            self._stack[-1].args.update(args)
+
+    def summary(self):
+        """ Returns dataframe of calls, total and self seconds, mean and max
+        milliseconds per stage, sorted by self time.
+        """
+        if not self.events:
+            return pd.DataFrame(columns=['stage', 'calls', 'total_s', 'self_s', 'mean_ms', 'max_ms', 'self_share'])
+        df = pd.DataFrame([e[:4] for e in self.events], columns=['stage', 'start', 'dur', 'self'])
+        summary = df.groupby('stage').agg(calls=('dur', 'size'), total_s=('dur', 'sum'),
+                                          self_s=('self', 'sum'), mean_ms=('dur', 'mean'),
+                                          max_ms=('dur', 'max'))
+        summary[['total_s', 'self_s']] /= 1e9
+        summary[['mean_ms', 'max_ms']] /= 1e6
+        summary['self_share'] = summary['self_s'] / summary['self_s'].sum()
+        return summary.sort_values('self_s', ascending=False).reset_index()
+
+    def rows(self, name='row'):
+        """ Returns dataframe of the spans of one stage (by default the
+        per-rating spans) with their seconds and annotations.
+        """
+        records = [dict(args, seconds=dur / 1e9) for stage, _, dur, _, args in self.events
+                   if stage == name]
+        return pd.DataFrame(records)
+
+    def slowest_users(self, n=20):
+        """ Returns dataframe of the n users whose rows took the longest in
+        total, with their largest ego graph.
+        """
+        rows = self.rows()
+        if rows.empty or 'user' not in rows:
+            return rows
+        agg = {'rows': ('seconds', 'size'), 'seconds': ('seconds', 'sum')}
+        for col in ('ego_nodes', 'ego_edges'):
+            if col in rows:
+                agg[col] = (col, 'max')
+        return rows.groupby('user').agg(**agg).nlargest(n, 'seconds').reset_index()
+
+    def trace_events(self):
+        """ Returns the events in the Chrome trace event format. """
+        origin = min((e[1] for e in self.events), default=0)
+        return [{'name': name, 'ph': 'X', 'ts': (start - origin) / 1e3, 'dur': dur / 1e3,
+                 'pid': self.pid, 'tid': self.tid,
+                 'args': {k: _jsonable(v) for k, v in args.items()}}
+                for name, start, dur, _, args in self.events]
+
+    def write_trace(self, filename):
+        """ Writes the events as a Chrome trace json file, readable by
+        chrome://tracing, Perfetto and speedscope.
+        """
+        with open(filename, 'w') as fh:
+            json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'}, fh)
+
+
+def _jsonable(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (int, float, str, bool)) or value is None:
+        return value
+    return str(value)
+
+
+def enable():
+    """ Starts recording stages in a new Profiler and returns it. """
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def disable():
+    """ Stops recording and returns the Profiler that was active, if any. """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+def enabled():
+    return _profiler is not None
+
+
+@contextmanager
+def profile(trace_file=None):
+    """ Records the stages run inside the block and optionally writes a
+    Chrome trace file on exit. Only the calling process is profiled, so use
+    n_workers=1 with parallel.parallel_feature_creation.
+    Usage:
+        with profile('trace.json') as prof:
+            f.feature_creation_iteration(otc_df, 'graph_target', f.GRAPH_TARGET_FEATURES)
+        print(prof.summary())
+    """
+    profiler = enable()
+    try:
+        yield profiler
+    finally:
+        disable()
+        if trace_file:
+            profiler.write_trace(trace_file)
+
+
+def stage(name, **args):
+    """ Returns a context manager timing a stage. When profiling is disabled
+    it is a shared no-op context, so instrumented code only pays a call.
+    """
+    if _profiler is None:
+        return _NULL
+    return _profiler.stage(name, **args)
+
+
+def annotate(**args):
+    """ Adds annotations (e.g. ego graph size) to the innermost open stage. """
+    if _profiler is not None:
+        _profiler.annotate(**args)
+
+
+def profiled(name=None):
+    """ Decorator timing every call of a function as a stage named after it. """
+    def decorator(fn):
+        stage_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return fn(*args, **kwargs)
+            with _profiler.stage(stage_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+if __name__ == '__main__':
+
+    import helpers as h
+    import features as f
+
+    parser = argparse.ArgumentParser(description='Profile feature generation on the first ratings.')
+    parser.add_argument('--data', default='../data/soc-sign-bitcoinotc.csv.gz')
+    parser.add_argument('--feature-type', default='graph_target', choices=f.FEATURE_TYPES)
+    parser.add_argument('--method', default='local', choices=['local', 'approx', 'auto', 'networkx'])
+    parser.add_argument('--batch', action='store_true', help='profile feature_creation_batch instead')
+    parser.add_argument('--rows', type=int, default=2000, help='number of ratings to process')
+    parser.add_argument('--trace', default='feature_trace.json')
+    args = parser.parse_args()
+
+    feature_lst = f.FEATURE_LISTS[args.feature_type]
+    with profile(args.trace) as prof:
+        otc_df = h.load_bitcoin_edge_data(args.data).iloc[:args.rows]
+        if args.batch:
+            f.feature_creation_batch(otc_df, args.feature_type, feature_lst, method=args.method)
+        else:
+            f.feature_creation_iteration(otc_df, args.feature_type, feature_lst, method=args.method)
+    print(prof.summary().to_string(index=False))
+    print(prof.slowest_users().to_string(index=False))
@@ -0,0 +1,243 @@
+import sys
+import time
+import pickle
+import argparse
+import datetime
+
+import pandas as pd
+import numpy as np
+import networkx as nx
+import helpers as h
+import features as f
+
+ID_COLUMNS = ['rater', 'ratee', 'rating', 'date']
+
+
+def event_date(timestamp):
+    """ Returns naive local datetime of a rating timestamp, converted the
+    same way as helpers.load_bitcoin_edge_data (epoch seconds truncated to
+    whole seconds). Datetimes and date strings are passed through.
+    """
+    if isinstance(timestamp, (int, float, np.integer, np.floating)):
+        return pd.Timestamp(datetime.datetime.fromtimestamp(int(np.floor(timestamp))))
+    return pd.Timestamp(timestamp)
+
+
+class OnlineScorer:
+    """ Keeps the live positive rating graph and per-user rating history in
+    memory, and scores each incoming rating on the state built from the
+    ratings before it. Ratings sharing a timestamp do not see each other,
+    matching the point-in-time features of the batch pipeline: their state
+    updates are held back until a later timestamp arrives.
+    Input:
+        model: fitted classifier with predict_proba, or None to only emit features
+        method: string (local/approx/auto/networkx), see features.ego_graph_features
+        cache_size: int number of users whose graph features are cached
+                    between ratings, see features.EgoFeatureCache
+        approx_degree, eps, time_budget: approximate mode settings, see
+                features.ego_graph_features
+    """
+
+    def __init__(self, model=None, method='local', cache_size=4096,
+                 approx_degree=None, eps=None, time_budget=None):
+        self.model = model
+        self.method = method
+        self.g = nx.DiGraph()
+        self.cache = f.EgoFeatureCache(cache_size, method, approx_degree, eps, time_budget)
+        # user -> [count, neg count, rating sum, first date, last date, last rating]
+        self.received = {}
+        # user -> [count, rating sum, first date, last date]
+        self.given = {}
+        self.current_date = None
+        self.pending = []
+        self.feature_names = getattr(model, 'feature_names_in_', None)
+
+    @classmethod
+    def from_history(cls, bitcoin_df, model=None, method='local', cache_size=4096,
+                     approx_degree=None, eps=None, time_budget=None):
+        """ Returns a scorer warmed up with the ratings in bitcoin_df,
+        as loaded by helpers.load_bitcoin_edge_data. Ratings at the last
+        history timestamp are held back like scored ones, so events sharing
+        that timestamp do not see them.
+        """
+        scorer = cls(model, method, cache_size, approx_degree, eps, time_budget)
+        df = bitcoin_df.sort_values('date', kind='stable')
+        if len(df):
+            scorer.current_date = df['date'].iloc[-1]
+            last = (df['date'] == scorer.current_date).values
+            held = df[last]
+            scorer.pending = list(zip(held['rater'].tolist(), held['ratee'].tolist(),
+                                      held['rating'].astype(np.int64).tolist(), held['date']))
+            df = df[~last]
+        scorer.g = h.build_graph(df, rating_type='pos', edge_attr=False)
+        rating = df['rating'].astype(np.int64)
+        received = df.assign(rating=rating, neg=rating < 0).groupby('ratee', sort=False)
+        received = received.agg(n=('rating', 'size'), neg=('neg', 'sum'), total=('rating', 'sum'),
+                                first=('date', 'first'), last=('date', 'last'),
+                                last_rating=('rating', 'last'))
+        scorer.received = {user: list(row) for user, row in
+                           zip(received.index, received.itertuples(index=False, name=None))}
+        given = df.assign(rating=rating).groupby('rater', sort=False)
+        given = given.agg(n=('rating', 'size'), total=('rating', 'sum'),
+                          first=('date', 'first'), last=('date', 'last'))
+        scorer.given = {user: list(row) for user, row in
+                        zip(given.index, given.itertuples(index=False, name=None))}
+        return scorer
+
+    def historical_features(self, ratee, rater, rate_date):
+        """ Returns the historical target and source feature arrays of a
+        rating, as historical_target_user_features and
+        historical_source_user_features compute them.
+        """
+        target = np.zeros(9)
+        if ratee in self.received:
+            n, neg, total, first, last, last_rating = self.received[ratee]
+            target = np.array([n, neg, n - neg, neg / n, total, total / n,
+                               (rate_date - first).days, (rate_date - last).days,
+                               last_rating < 0], dtype=float)
+        source = np.zeros(4)
+        if rater in self.given:
+            n, total, first, last = self.given[rater]
+            source = np.array([n, total / n, (rate_date - first).days,
+                               (rate_date - last).days], dtype=float)
+        return target, source
+
+    def features(self, rater, ratee, rating, timestamp):
+        """ Returns one-row dataframe holding the rating and its full feature
+        vector (historical, normalized graph and graph difference features)
+        without updating the state.
+        """
+        rate_date = event_date(timestamp)
+        self._advance(rate_date)
+        target, source = self.historical_features(ratee, rater, rate_date)
+        graph_target = self.cache.features(self.g, ratee)
+        graph_source = self.cache.features(self.g, rater)
+        row = dict(zip(ID_COLUMNS, [rater, ratee, rating, rate_date]))
+        row.update(zip(f.HISTORICAL_TARGET_FEATURES, target))
+        row.update(zip(f.HISTORICAL_SOURCE_FEATURES, source))
+        row.update(zip(f.GRAPH_TARGET_FEATURES, graph_target))
+        row.update(zip(f.GRAPH_SOURCE_FEATURES, graph_source))
+        return f.graph_feature_stage(pd.DataFrame([row]))
+
+    def score(self, rater, ratee, rating, timestamp):
+        """ Returns the model score and the feature row of an incoming
+        rating, then adds the rating to the state.
+        """
+        df = self.features(rater, ratee, rating, timestamp)
+        score = np.nan
+        if self.model is not None:
+            X = df.drop(ID_COLUMNS, axis=1)
+            if self.feature_names is not None:
+                X = X[list(self.feature_names)]
+            score = self.model.predict_proba(X)[0, 1]
+        self.pending.append((rater, ratee, rating, df['date'].iloc[0]))
+        return score, df
+
+    def run(self, events):
+        """ Scores a stream of (rater, ratee, rating, timestamp) events.
+        Output:
+            generator of (score, feature row dataframe, seconds spent scoring)
+        """
+        for rater, ratee, rating, timestamp in events:
+            start = time.perf_counter()
+            score, df = self.score(rater, ratee, rating, timestamp)
+            yield score, df, time.perf_counter() - start
+
+    def _advance(self, rate_date):
+        # ratings from earlier timestamps become visible once time moves on
+        if self.current_date is not None and rate_date > self.current_date:
+            self.flush()
+        self.current_date = rate_date if self.current_date is None else max(self.current_date, rate_date)
+
+    def flush(self):
+        """ Applies the held back ratings to the graph and user history. """
+        for rater, ratee, rating, rate_date in self.pending:
+            if rating > 0 and not self.g.has_edge(rater, ratee):
+                self.g.add_edge(rater, ratee)
+                self.cache.invalidate_edge(self.g, rater, ratee)
+            rec = self.received.setdefault(ratee, [0, 0, 0, rate_date, rate_date, rating])
+            rec[0] += 1
+            rec[1] += rating < 0
+            rec[2] += rating
+            rec[4] = rate_date
+            rec[5] = rating
+            giv = self.given.setdefault(rater, [0, 0, rate_date, rate_date])
+            giv[0] += 1
+            giv[1] += rating
+            giv[3] = rate_date
+        self.pending = []
+
+
+def iter_csv_events(fh, follow=False, poll=0.5):
+    """ Yields (rater, ratee, rating, timestamp) events from csv lines in
+    the SNAP format (rater,ratee,rating,epoch). With follow, keeps waiting
+    for lines appended to the file, like tail -f. A line is parsed once its
+    newline arrives, so lines read while the writer is appending them are
+    not split, and malformed lines are reported on stderr and skipped.
+    Input:
+        fh: open text file, e.g. sys.stdin
+        follow: bool
+        poll: seconds to sleep when no new line is available
+    """
+    buffer = ''
+    while True:
+        chunk = fh.readline()
+        if chunk:
+            buffer += chunk
+            if not buffer.endswith('\n'):
+                # partial line, the rest is still being written
+                continue
+        elif follow:
+            time.sleep(poll)
+            continue
+        elif not buffer:
+            return
+        # a complete line, or the last line of a file without a final newline
+        line, buffer = buffer.strip(), ''
+        if not line:
+            continue
+        try:
+            rater, ratee, rating, timestamp = line.split(',')
+            event = int(rater), int(ratee), int(rating), float(timestamp)
+        except ValueError:
+            print(f"Skipping malformed event line: {line!r}", file=sys.stderr)
+            continue
+        yield event
+
+
+def iter_queue_events(event_queue, sentinel=None):
+    """ Yields events put on an in-process queue.Queue until sentinel is received. """
+    while True:
+        event = event_queue.get()
+        if event is sentinel:
+            return
+        yield event
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Score bitcoin ratings as they arrive.')
+    parser.add_argument('--history', default='../data/soc-sign-bitcoinotc.csv.gz',
+                        help='gzipped ratings used to warm up the graph and user history')
+    parser.add_argument('--model', help='pickled classifier with predict_proba')
+    parser.add_argument('--events', default='-', help='csv file of new ratings, - for stdin')
+    parser.add_argument('--follow', action='store_true', help='keep reading lines appended to --events')
+    parser.add_argument('--method', default='local', choices=['local', 'approx', 'auto', 'networkx'])
+    parser.add_argument('--approx-degree', type=int, help='rater count above which auto samples')
+    parser.add_argument('--eps', type=float, help='relative standard error target of sampling')
+    parser.add_argument('--time-budget', type=float, help='seconds of sampling per user')
+    args = parser.parse_args()
+
+    model = None
+    if args.model:
+        with open(args.model, 'rb') as fh:
+            model = pickle.load(fh)
+    otc_df = h.load_bitcoin_edge_data(args.history, cache=True)
+    scorer = OnlineScorer.from_history(otc_df, model, args.method, approx_degree=args.approx_degree,
+                                       eps=args.eps, time_budget=args.time_budget)
+
+    fh = sys.stdin if args.events == '-' else open(args.events)
+    for score, df, seconds in scorer.run(iter_csv_events(fh, follow=args.follow)):
+        row = df.iloc[0]
+        print(f"{row['rater']},{row['ratee']},{row['rating']},{row['date']},{score:.4f},{1000 * seconds:.1f}ms",
+              flush=True)
@@ -0,0 +1,390 @@
+import argparse
+from itertools import product
+
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+import helpers as h
+import features as f
+import triads as t
+
+# the 14 graph feature names without the _target/_source suffix
+SNAPSHOT_FEATURES = [name[:-len('_target')] for name in f.GRAPH_TARGET_FEATURES]
+
+# Dyad states between local nodes a < b: 0 none, 1 a->b, 2 b->a, 3 mutual.
+# Seen from a focal node, 1 is an out edge, 2 an in edge and 3 a mutual one.
+FLIP = (0, 2, 1, 3)
+
+
+def _triad_class(d01, d02, d12):
+    """ Returns the census index of the triad of local nodes 0, 1, 2 with
+    the given dyad states.
+    """
+    succ = [set(), set(), set()]
+    for (a, b), state in (((0, 1), d01), ((0, 2), d02), ((1, 2), d12)):
+        if state in (1, 3):
+            succ[a].add(b)
+        if state in (2, 3):
+            succ[b].add(a)
+    return t._tricode(succ, 0, 1, 2)
+
+
+def _class_tables():
+    """ Returns, per census index, the number of asymmetric and of mutual
+    dyads, and the (sorted dyad state pair) of the wedge at each node of the
+    triangle classes, from one representative triad of every class.
+    """
+    asym = np.zeros(16, dtype=np.int64)
+    mutual = np.zeros(16, dtype=np.int64)
+    closed_wedges = {}
+    for d01, d02, d12 in product(range(4), repeat=3):
+        k = _triad_class(d01, d02, d12)
+        states = (d01, d02, d12)
+        asym[k] = sum(s in (1, 2) for s in states)
+        mutual[k] = sum(s == 3 for s in states)
+        if 0 not in states and k not in closed_wedges:
+            # dyad states seen from node 0, node 1 and node 2
+            wedges = [tuple(sorted((d01, d02))),
+                      tuple(sorted((FLIP[d01], d12))),
+                      tuple(sorted((FLIP[d02], FLIP[d12])))]
+            closed_wedges[k] = wedges
+    return asym, mutual, closed_wedges
+
+
+ASYM_DYADS, MUTUAL_DYADS, CLOSED_WEDGES = _class_tables()
+WEDGE_TYPES = [(1, 1), (2, 2), (3, 3), (1, 2), (1, 3), (2, 3)]
+
+
+def adjacency_matrix(g):
+    """ Returns the nodes of g and its CSR adjacency matrix (int64 ones,
+    self ratings dropped), row i holding the ratings given by nodes[i].
+    """
+    nodes = list(g)
+    local = {v: i for i, v in enumerate(nodes)}
+    edges = [(local[a], local[b]) for a, b in g.edges() if a != b]
+    rows, cols = np.array(edges, dtype=np.int64).reshape(-1, 2).T
+    A = sp.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)),
+                      shape=(len(nodes), len(nodes)))
+    return nodes, A
+
+
+def _colsum(M):
+    return np.asarray(M.sum(axis=0)).ravel()
+
+
+def _entries(A, rows, cols):
+    """ Returns array of the entries A[rows[i], cols[i]]. """
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.asarray(A[rows, cols]).ravel()
+
+
+def _batches(cost, budget):
+    """ Yields (lo, hi) ranges of items whose summed cost stays within
+    budget, with at least one item per range.
+    """
+    cum = np.cumsum(cost)
+    lo = 0
+    while lo < len(cum):
+        before = cum[lo - 1] if lo else 0
+        hi = max(int(np.searchsorted(cum, before + budget, side='right')), lo + 1)
+        yield lo, hi
+        lo = hi
+
+
+def _row_lengths(X):
+    return np.diff(X.indptr)
+
+
+def _triangle_classes(A, budget=1 << 21):
+    """ Returns (16, n) array counting, per node u, the triangles of each
+    census class among the raters of u. Triangles are listed once (i < j < k)
+    from the upper triangle of the undirected graph, and the nodes rating
+    all three corners are found by multiplying their adjacency rows. Edges
+    and triangles are taken in batches of about budget row entries.
+    """
+    n = A.shape[0]
+    U = ((A + A.T) > 0).astype(np.int64)
+    L = sp.triu(U, k=1).tocsr()
+    ei, ej = L.nonzero()
+    counts = np.zeros((16, n), dtype=np.int64)
+    for lo, hi in _batches(_row_lengths(L)[ei] + _row_lengths(L)[ej], budget):
+        bi, bj = ei[lo:hi], ej[lo:hi]
+        # third corners k > j adjacent to both ends of each edge
+        Q = L[bi].multiply(L[bj]).tocoo()
+        if Q.nnz == 0:
+            continue
+        ti, tj, tk = bi[Q.row], bj[Q.row], Q.col
+        code = (_entries(A, ti, tj) + 2 * _entries(A, tj, ti) + 4 * _entries(A, ti, tk) +
+                8 * _entries(A, tk, ti) + 16 * _entries(A, tj, tk) + 32 * _entries(A, tk, tj))
+        cls = np.asarray(t.TRICODES)[code] - 1
+        # nodes rated by both ends of each edge, then by the third corner too
+        edges, edge_of = np.unique(Q.row, return_inverse=True)
+        both = A[bi[edges]].multiply(A[bj[edges]]).tocsr()
+        rated = _row_lengths(both)[edge_of] > 0
+        edge_of, tk, cls = edge_of[rated], tk[rated], cls[rated]
+        for tlo, thi in _batches(_row_lengths(both)[edge_of] + _row_lengths(A)[tk], budget):
+            raters_of = both[edge_of[tlo:thi]].multiply(A[tk[tlo:thi]])
+            indicator = sp.csr_matrix((np.ones(thi - tlo, dtype=np.int64),
+                                       (cls[tlo:thi], np.arange(thi - tlo))),
+                                      shape=(16, thi - tlo))
+            counts += (indicator @ raters_of).toarray()
+    return counts
+
+
+def _support_products(A, M, Aa, budget=1 << 21):
+    """ Returns the 2-path products Aa @ M, Aa @ Aa, M @ M, M @ Aa,
+    Aa.T @ M and Aa.T @ Aa restricted to the entries of A, as CSR matrices
+    sharing the structure of A, so the full products are never built. An
+    entry (i, j) counts the middle nodes k by the dyad states of i-k and k-j.
+    These are read at once from the product of row i and row j of two
+    matrices that code the dyad states as values whose products are all
+    distinct. Edges are taken in batches of about budget row entries.
+    """
+    n = A.shape[0]
+    AaT = Aa.T.tocsr()
+    # i-k coded 1 (i -> k), 3 (mutual) or 9 (k -> i), k-j read from row j as
+    # 2 (mutual) or 5 (k -> j only)
+    X = (Aa + 3 * M + 9 * AaT).tocsr()
+    Y = (2 * M + 5 * AaT).tocsr()
+    codes = (1 * 2, 1 * 5, 3 * 2, 3 * 5, 9 * 2, 9 * 5)
+    ei = np.repeat(np.arange(n), _row_lengths(A))
+    ej = A.indices
+    values = np.zeros((len(codes), len(ej)), dtype=np.int64)
+    for lo, hi in _batches(_row_lengths(X)[ei] + _row_lengths(Y)[ej], budget):
+        P = X[ei[lo:hi]].multiply(Y[ej[lo:hi]]).tocoo()
+        for vals, code in zip(values, codes):
+            vals[lo:hi] = np.bincount(P.row[P.data == code], minlength=hi - lo)
+    return [sp.csr_matrix((vals, A.indices, A.indptr), shape=A.shape) for vals in values]
+
+
+def ego_census(A):
+    """ Returns the triad census of the reverse ego graph of every node
+    (the node and its raters), computed for all nodes at once with sparse
+    products, and the matrices reused by snapshot_user_features.
+    Input:
+        A: CSR adjacency matrix, as returned by adjacency_matrix
+    Output:
+        census: array of shape (n, 16), columns in triads.TRIAD_NAMES order
+        parts: dict of per node arrays and masked product matrices
+    """
+    n = A.shape[0]
+    M = A.multiply(A.T).tocsr()
+    Aa = (A - M).tocsr()
+    r = _colsum(M)
+    s = _colsum(Aa)
+    p = r + s
+
+    # 2-path counts, only needed where one end rates the other
+    AaM, AaAa, MM, MAa, AaTM, AaTAa = _support_products(A, M, Aa)
+    census = np.zeros((16, n), dtype=np.int64)
+
+    # triads of the node u with two raters v, w. u-v is mutual when v is a
+    # reciprocated rater (R), else v -> u (S). Count v-w dyads per class pair
+    a_rr = _colsum(AaM.multiply(M))
+    a_rs = _colsum(AaAa.multiply(M))
+    a_sr = _colsum(AaM.multiply(Aa))
+    a_ss = _colsum(AaAa.multiply(Aa))
+    m_rr = _colsum(MM.multiply(M)) // 2
+    m_rs = _colsum(MAa.multiply(M))
+    m_ss = _colsum(MAa.multiply(Aa)) // 2
+    for count, config in ((a_rr, (3, 3, 1)), (a_rs, (3, 2, 1)), (a_sr, (2, 3, 1)), (a_ss, (2, 2, 1)),
+                          (m_rr, (3, 3, 3)), (m_rs, (3, 2, 3)), (m_ss, (2, 2, 3)),
+                          (r * (r - 1) // 2 - a_rr - m_rr, (3, 3, 0)),
+                          (r * s - a_rs - a_sr - m_rs, (3, 2, 0)),
+                          (s * (s - 1) // 2 - a_ss - m_ss, (2, 2, 0))):
+        census[_triad_class(*config)] += count
+
+    # triads among the raters: degrees of each rater x of u within the raters
+    # of u by dyad state, at the entries where x rates u
+    d_out = (AaM + AaAa).tocsr()
+    d_in = (AaTM + AaTAa).tocsr()
+    d_mut = (MM + MAa).tocsr()
+    wedges = {(1, 1): (_colsum(d_out.multiply(d_out)) - _colsum(d_out)) // 2,
+              (2, 2): (_colsum(d_in.multiply(d_in)) - _colsum(d_in)) // 2,
+              (3, 3): (_colsum(d_mut.multiply(d_mut)) - _colsum(d_mut)) // 2,
+              (1, 2): _colsum(d_out.multiply(d_in)),
+              (1, 3): _colsum(d_out.multiply(d_mut)),
+              (2, 3): _colsum(d_in.multiply(d_mut))}
+    inner = _triangle_classes(A)
+    closed = {pair: 0 for pair in WEDGE_TYPES}
+    for k, pairs in CLOSED_WEDGES.items():
+        for pair in pairs:
+            closed[pair] = closed[pair] + inner[k]
+    for pair in WEDGE_TYPES:
+        inner[_triad_class(pair[0], pair[1], 0)] += wedges[pair] - closed[pair]
+
+    # single dyad triads: every third rater not linked to the dyad
+    n_asym = _colsum(d_out)
+    n_mutual = _colsum(d_mut) // 2
+    inner[t.TRIAD_012] = n_asym * np.maximum(p - 2, 0) - ASYM_DYADS @ inner
+    inner[t.TRIAD_102] = n_mutual * np.maximum(p - 2, 0) - MUTUAL_DYADS @ inner
+    inner[t.TRIAD_003] = p * (p - 1) * (p - 2) // 6 - inner.sum(axis=0)
+    census += inner
+
+    parts = {'p': p, 'r': r, 'M': M, 'A': A, 'd_out': d_out, 'd_in': d_in, 'd_mut': d_mut,
+             'AaM': AaM, 'AaTM': AaTM, 'MM': MM, 'n_inner_edges': n_asym + n_mutual}
+    return census.T, parts
+
+
+def _ego_clustering(parts):
+    """ Returns the directed clustering coefficient of every node in its
+    reverse ego graph, as networkx.clustering computes it there.
+    """
+    p, r, M, A = parts['p'], parts['r'], parts['M'], parts['A']
+    # per rater j of u: its ratings with other raters, plus those with
+    # reciprocated raters again, doubled when j is reciprocated itself
+    links = (parts['d_out'] + parts['d_in'] + 2 * parts['d_mut'] +
+             (parts['AaM'] + parts['MM']).multiply(A) + (parts['AaTM'] + parts['MM']).multiply(A))
+    triangles = _colsum(links.multiply(A + M))
+    dtotal = p + r
+    denom = (dtotal * (dtotal - 1) - 2 * r) * 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(triangles > 0, triangles / denom, 0.0)
+
+
+def _focal_betweenness(S, recip):
+    """ Returns the normalized betweenness of a node u in its reverse ego
+    graph, from the dense adjacency S among its p raters and the mask of
+    raters u rates back. A shortest path through u always starts s -> u
+    (a detour to u is longer), so it reaches t in 1 + d(u, t) steps and u
+    carries sigma(u, t) of the sigma(u, t) + sigma_S(s, t) shortest paths
+    when the raters alone need as many steps, all of them when they need
+    more, and none when they need fewer.
+    """
+    p = len(S)
+    # shortest path distance and count from u to every rater
+    dist_u = np.full(p, np.inf)
+    sigma_u = np.zeros(p)
+    frontier = recip.copy()
+    dist_u[frontier] = 1
+    sigma_u[frontier] = 1
+    level = 1
+    while frontier.any():
+        reach = sigma_u[frontier] @ S[frontier]
+        frontier = (reach > 0) & np.isinf(dist_u)
+        level += 1
+        dist_u[frontier] = level
+        sigma_u[frontier] = reach[frontier]
+    via_u = dist_u + 1
+    max_level = via_u[np.isfinite(via_u)].max()
+
+    # shortest path counts among the raters, from every rater at once, up to
+    # the longest route through u
+    dist_s = np.where(S > 0, 1.0, np.inf)
+    np.fill_diagonal(dist_s, 0)
+    sigma_s = S.astype(float)
+    paths = sigma_s
+    level = 1
+    while level < max_level and paths.any():
+        paths = paths @ S
+        paths[np.isfinite(dist_s)] = 0
+        level += 1
+        dist_s[paths > 0] = level
+        sigma_s = sigma_s + paths
+
+    reached = np.isfinite(via_u)[None, :] & (dist_s >= via_u[None, :])
+    np.fill_diagonal(reached, False)
+    tied = reached & (dist_s == via_u[None, :])
+    share = np.where(tied, sigma_u[None, :] / (sigma_u[None, :] + sigma_s), 1.0)
+    return share[reached].sum() / (p * (p - 1))
+
+
+def _ego_betweenness(parts):
+    """ Returns the normalized betweenness of every node in its reverse ego
+    graph. A node u only lies on paths leaving through its reciprocated
+    raters. When its raters never rate each other, every rater reaches each
+    of them through u alone, which gives r / p. The remaining nodes count
+    shortest paths on the dense adjacency among their raters.
+    """
+    p, r, A = parts['p'], parts['r'], parts['A']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        betweenness = np.where(p > 1, r / p, 0.0)
+    AT = A.T.tocsr()
+    # local id of each rater of the current node, -1 elsewhere
+    local = np.full(A.shape[0], -1, dtype=np.int64)
+    for u in np.flatnonzero((r > 0) & (p > 1) & (parts['n_inner_edges'] > 0)):
+        raters = AT.indices[AT.indptr[u]:AT.indptr[u + 1]]
+        local[raters] = np.arange(len(raters))
+        starts, stops = A.indptr[raters], A.indptr[raters + 1]
+        lengths = stops - starts
+        row = np.repeat(np.arange(len(raters)), lengths)
+        col = local[A.indices[np.repeat(starts - np.cumsum(lengths) + lengths, lengths) +
+                              np.arange(lengths.sum())]]
+        S = np.zeros((len(raters), len(raters)))
+        S[row[col >= 0], col[col >= 0]] = 1
+        recip = np.zeros(len(raters), dtype=bool)
+        rated = local[A.indices[A.indptr[u]:A.indptr[u + 1]]]
+        recip[rated[rated >= 0]] = True
+        betweenness[u] = _focal_betweenness(S, recip)
+        local[raters] = -1
+    return betweenness
+
+
+def snapshot_user_features(g, users=None, betweenness=True):
+    """ Returns dataframe of the 14 graph features of users in the positive
+    ratings graph g, matching features.ego_graph_features for every user,
+    with the in degree, out degree and reciprocated ratings of each user in
+    g. The whole graph is processed at once as a sparse matrix instead of
+    one ego graph per user.
+    Input:
+        g: networkx DiGraph of positive ratings, e.g. built with
+           helpers.build_graph(bitcoin_df, rating_type='pos', rating_date=date)
+        users: optional list of users to return, default every node of g.
+               Users not in g get zeros
+        betweenness: bool. False skips the betweenness column (set to 0),
+                     the only one needing per user work
+    Output:
+        dataframe indexed on user
+    """
+    nodes, A = adjacency_matrix(g)
+    census, parts = ego_census(A)
+    p, r = parts['p'], parts['r']
+    # a self rating makes the user one of its own raters in neighbors_in
+    self_rated = np.array([v in g._pred[v] for v in nodes], dtype=np.int64)
+    names = dict(zip(t.TRIAD_NAMES, census.T))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        arr = np.column_stack([names['300'],
+                               names['210'],
+                               names['120U'] + names['120D'] + names['120C'],
+                               names['030T'],
+                               names['030C'],
+                               names['201'],
+                               names['111U'] + names['111D'],
+                               names['102'],
+                               names['021U'] + names['021D'] + names['021C'],
+                               census.sum(axis=1),
+                               _ego_clustering(parts),
+                               p + self_rated,
+                               _ego_betweenness(parts) if betweenness else np.zeros(len(nodes)),
+                               (p - r) / p]).astype(float)
+    arr[np.isnan(arr)] = 0
+    # reverse ego graphs of two nodes or less have no features
+    arr[p <= 1] = 0
+    df = pd.DataFrame(arr, index=pd.Index(nodes, name='user'), columns=SNAPSHOT_FEATURES)
+    df['in_degree'] = _colsum(A)
+    df['out_degree'] = np.asarray(A.sum(axis=1)).ravel()
+    df['reciprocal_ratings'] = r
+    if users is not None:
+        df = df.reindex(users, fill_value=0)
+    return df
+
+
+def snapshot_features(bitcoin_df, rate_date='', users=None, betweenness=True):
+    """ Returns snapshot_user_features on the positive ratings made before
+    rate_date, e.g. to score every active user at month end.
+    """
+    g = h.build_graph(bitcoin_df, rating_type='pos', rating_date=rate_date, edge_attr=False)
+    return snapshot_user_features(g, users, betweenness)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Graph features of every user on one snapshot.')
+    parser.add_argument('--data', default='../data/soc-sign-bitcoinotc.csv.gz')
+    parser.add_argument('--date', default='', help='snapshot date, ratings before it are used')
+    parser.add_argument('--output', default='../data/snapshot_graph_features.csv')
+    args = parser.parse_args()
+
+    otc_df = h.load_bitcoin_edge_data(args.data)
+    snapshot_features(otc_df, args.date).to_csv(args.output)
@@ -0,0 +1,86 @@
+import os
+import json
+import shutil
+import argparse
+
+import numpy as np
+import helpers as h
+
+# A store is a directory holding one .npy file per helpers.RatingIndex field
+# (date-sorted rating columns and per-user CSR offsets) and a meta.json.
+# Arrays are opened read-only with np.load(mmap_mode='r'), so every process
+# opening the same store shares the operating system's page cache of it.
+STORE_VERSION = 1
+
+# stores opened by this process, keyed on absolute path
+_open_stores = {}
+
+
+def write_store(bitcoin_df, path):
+    """ Writes the RatingIndex of the bitcoin ratings to a store directory,
+    replacing any store already there.
+    Input:
+        bitcoin_df: dataframe of bitcoin ratings, as loaded by
+                    helpers.load_bitcoin_edge_data
+        path: store directory
+    """
+    index = h.build_rating_index(bitcoin_df)
+    tmp = path.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for field, arr in zip(index._fields, index):
+        if arr.dtype == object:
+            # labels that cannot be memory mapped, rows are then labelled by position
+            continue
+        np.save(os.path.join(tmp, f'{field}.npy'), np.ascontiguousarray(arr))
+    meta = {'version': STORE_VERSION,
+            'n_ratings': len(index.date),
+            'n_users': len(index.users),
+            'fields': list(index._fields)}
+    with open(os.path.join(tmp, 'meta.json'), 'w') as fh:
+        json.dump(meta, fh, indent=1)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    _open_stores.pop(os.path.abspath(path), None)
+
+
+def open_store(path):
+    """ Returns the helpers.RatingIndex of a store with every field memory
+    mapped read-only. Pass it as the index argument of helpers.user_data,
+    helpers.build_graph and the feature functions, with bitcoin_df None.
+    Repeated calls in a process return the same index.
+    """
+    key = os.path.abspath(path)
+    if key not in _open_stores:
+        with open(os.path.join(path, 'meta.json')) as fh:
+            meta = json.load(fh)
+        if meta['version'] != STORE_VERSION:
+            raise ValueError(f"{path} is a version {meta['version']} store, expected {STORE_VERSION}")
+        files = [os.path.join(path, f'{field}.npy') for field in h.RatingIndex._fields]
+        arrays = [np.load(file, mmap_mode='r') if os.path.exists(file) else None for file in files]
+        _open_stores[key] = h.RatingIndex(*arrays)
+    return _open_stores[key]
+
+
+def open_or_write_store(filename, path=None):
+    """ Returns the memory mapped index of a gzipped ratings csv, writing
+    the store next to it first if it is missing or older than the csv.
+    Input:
+        filename: csv file with gzip compression
+        path: store directory, defaults to filename with a .store suffix
+    """
+    path = path or filename + '.store'
+    meta = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta) or os.path.getmtime(meta) < os.path.getmtime(filename):
+        write_store(h.load_bitcoin_edge_data(filename), path)
+    return open_store(path)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Write the memory mapped rating store of a ratings csv.')
+    parser.add_argument('--data', default='../data/soc-sign-bitcoinotc.csv.gz')
+    parser.add_argument('--store', help='store directory, defaults to the csv name with a .store suffix')
+    args = parser.parse_args()
+
+    write_store(h.load_bitcoin_edge_data(args.data), args.store or args.data + '.store')
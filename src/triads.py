@@ -0,0 +1,340 @@
+import time
+
+import numpy as np
+import profiling as pr
+
+# Batagelj and Mrvar triad codes, as used by networkx.triadic_census:
+# each of the six possible edges of a triad sets one bit of the code.
+TRIAD_NAMES = ('003', '012', '102', '021D', '021U', '021C', '111D', '111U',
+               '030T', '030C', '201', '120D', '120U', '120C', '210', '300')
+TRICODES = (1, 2, 2, 3, 2, 4, 6, 8, 2, 6, 5, 7, 3, 8, 7, 11, 2, 6, 4, 8, 5, 9,
+            9, 13, 6, 10, 9, 14, 7, 14, 12, 15, 2, 5, 6, 7, 6, 9, 10, 14, 4, 9,
+            9, 12, 8, 13, 14, 15, 3, 7, 8, 11, 7, 12, 14, 15, 8, 14, 13, 15, 11,
+            15, 15, 16)
+TRIAD_003, TRIAD_012, TRIAD_102 = 0, 1, 2
+
+
+def _tricode(succ, v, u, w):
+    """ Returns the census index (position in TRIAD_NAMES) of triad v, u, w.
+    Input:
+        succ: list of successor sets
+        v, u, w: int local node ids
+    """
+    code = ((u in succ[v]) + 2 * (v in succ[u]) + 4 * (w in succ[v]) +
+            8 * (v in succ[w]) + 16 * (w in succ[u]) + 32 * (u in succ[w]))
+    return TRICODES[code] - 1
+
+
+@pr.profiled()
+def ego_adjacency(g, user):
+    """ Returns CSR out-adjacency arrays of the reverse ego graph of a user:
+    the user and everyone who rated them, with all ratings among them.
+    Cost is bounded by the edges among the user's raters, since the
+    successors of a prolific rater are only scanned when they are fewer
+    than the raters themselves. Self ratings are ignored.
+    Input:
+        g: networkx DiGraph
+        user: node in g
+    Output:
+        nodes: list of graph nodes, local id 0 is the user
+        indptr: array of row offsets into indices
+        indices: array of local successor ids
+    """
+    nodes = [user] + [v for v in g._pred[user] if v != user]
+    local = {v: i for i, v in enumerate(nodes)}
+    indptr = [0]
+    indices = []
+    for v in nodes:
+        nbrs = g._succ[v]
+        if len(nbrs) < len(nodes):
+            out = [local[w] for w in nbrs if w in local]
+        else:
+            out = [i for i, w in enumerate(nodes) if w in nbrs]
+        indices.extend(sorted(i for i in out if nodes[i] != v))
+        indptr.append(len(indices))
+    return nodes, np.array(indptr, dtype=np.int64), np.array(indices, dtype=np.int64)
+
+
+def _edge_triads(succ, nbrs, v, u, n, census):
+    """ Adds to census the triads that the Batagelj and Mrvar census
+    attributes to the linked pair v < u, and returns how many of them are
+    connected (have at least two linked pairs).
+    """
+    neighbors = (nbrs[v] | nbrs[u]) - {u, v}
+    # dyadic triads: the third node is linked to neither u nor v
+    if u in succ[v] and v in succ[u]:
+        census[TRIAD_102] += n - len(neighbors) - 2
+    else:
+        census[TRIAD_012] += n - len(neighbors) - 2
+    connected = 0
+    for w in neighbors:
+        if u < w or (v < w < u and w not in nbrs[v]):
+            census[_tricode(succ, v, u, w)] += 1
+            connected += 1
+    return connected
+
+
+def _within_error(total, total_sq, k, population, eps):
+    """ Returns True when the estimate population * total / k of a sum over
+    a population, from k items sampled without replacement, has a relative
+    standard error of at most eps.
+    """
+    mean = total / k
+    var = max(total_sq - total * mean, 0.0) / (k - 1)
+    se = population * np.sqrt((1 - k / population) * var / k)
+    return se <= eps * population * abs(mean)
+
+
+@pr.profiled()
+def local_census(succ, pred, nodes):
+    """ Returns triad census counts of the subgraph induced by nodes,
+    counting only the connected triads explicitly (Batagelj and Mrvar),
+    so cost grows with the edges among nodes rather than with node triples.
+    Input:
+        succ: list of successor sets indexed by local id
+        pred: list of predecessor sets indexed by local id
+        nodes: sorted list of local ids to restrict the census to
+    Output:
+        list of 16 counts ordered as TRIAD_NAMES
+    """
+    census = [0] * 16
+    n = len(nodes)
+    keep = set(nodes)
+    nbrs = {v: (succ[v] | pred[v]) & keep for v in nodes}
+    for v in nodes:
+        for u in nbrs[v]:
+            if u > v:
+                _edge_triads(succ, nbrs, v, u, n, census)
+    census[TRIAD_003] = n * (n - 1) * (n - 2) // 6 - sum(census)
+    return census
+
+
+@pr.profiled()
+def sampled_census(succ, pred, nodes, eps=0.05, deadline=None, rng=None, min_samples=64, batch_size=64):
+    """ Returns estimated triad census counts of the subgraph induced by
+    nodes. Linked pairs are visited in random order and the triads each
+    one is attributed by local_census are counted, until the estimated
+    number of connected triads has a relative standard error of at most
+    eps or the deadline passes. Connected counts are scaled up by the share
+    of pairs visited. Dyadic counts are taken exactly from the degrees of
+    every pair, with only the correction for third nodes linked to both
+    estimated, and all counts are exact once every pair has been visited.
+    Input:
+        succ, pred, nodes: as for local_census
+        eps: float relative standard error target
+        deadline: optional time.perf_counter() value to stop sampling at
+        rng: numpy Generator
+        min_samples: int number of pairs visited before stopping early
+        batch_size: int number of pairs visited between checks
+    Output:
+        list of 16 float counts ordered as TRIAD_NAMES
+    """
+    rng = rng or np.random.default_rng(0)
+    census = [0] * 16
+    n = len(nodes)
+    keep = set(nodes)
+    nbrs = {v: (succ[v] | pred[v]) & keep for v in nodes}
+    pairs = [(v, u) for v in nodes for u in nbrs[v] if u > v]
+    # third nodes linked to neither of a pair, if none were linked to both
+    dyads = [(TRIAD_102 if u in succ[v] and v in succ[u] else TRIAD_012,
+              n - len(nbrs[v]) - len(nbrs[u])) for v, u in pairs]
+    exact_dyadic = {TRIAD_012: 0, TRIAD_102: 0}
+    for idx, count in dyads:
+        exact_dyadic[idx] += count
+    sampled_dyadic = {TRIAD_012: 0, TRIAD_102: 0}
+    order = rng.permutation(len(pairs))
+    total, total_sq, k = 0, 0, 0
+    while k < len(pairs):
+        for i in order[k:k + batch_size]:
+            connected = _edge_triads(succ, nbrs, *pairs[i], n, census)
+            total += connected
+            total_sq += connected * connected
+            idx, count = dyads[i]
+            sampled_dyadic[idx] += count
+        k = min(k + batch_size, len(pairs))
+        if k >= min_samples and k < len(pairs) and (
+                _within_error(total, total_sq, k, len(pairs), eps) or
+                (deadline is not None and time.perf_counter() > deadline)):
+            break
+    pr.annotate(pairs=len(pairs), sampled_pairs=k)
+    scale = len(pairs) / k if k else 1.0
+    census = [count * scale for count in census]
+    for idx in exact_dyadic:
+        census[idx] += exact_dyadic[idx] - sampled_dyadic[idx] * scale
+    census[TRIAD_003] = n * (n - 1) * (n - 2) / 6 - sum(census)
+    return census
+
+
+def _reached_from(succ, source):
+    """ Returns the set of local ids reachable from source. """
+    reached = {source}
+    frontier = [source]
+    while frontier:
+        frontier = [w for v in frontier for w in succ[v] if w not in reached]
+        reached.update(frontier)
+    return reached
+
+
+def _path_shares(pred, t):
+    """ Returns list of the shares of the shortest paths ending at t that
+    run through node 0, one per source, searching backwards from t.
+    """
+    dist = {t: 0}
+    sigma = {t: 1}
+    frontier = [t]
+    while frontier:
+        nxt = []
+        for w in frontier:
+            for v in pred[w]:
+                if v not in dist:
+                    dist[v] = dist[w] + 1
+                    sigma[v] = 0
+                    nxt.append(v)
+                if dist[v] == dist[w] + 1:
+                    sigma[v] += sigma[w]
+        frontier = nxt
+    via = dist[0] + 1
+    return [sigma[0] / sigma[s] for s, d in dist.items() if d == via]
+
+
+@pr.profiled()
+def ego_betweenness(succ, pred, n):
+    """ Returns the normalized betweenness centrality of local node 0 in
+    an ego graph where every other node links to node 0. A shortest s-t
+    path runs through node 0 only if its length is 1 + d(0, t), so only
+    targets reachable from node 0 are searched, backwards from t.
+    Input:
+        succ: list of successor sets indexed by local id
+        pred: list of predecessor sets indexed by local id
+        n: int number of nodes in the ego graph
+    Output:
+        float
+    """
+    if n <= 2 or not succ[0]:
+        return 0.0
+    betweenness = 0.0
+    for t in _reached_from(succ, 0):
+        if t != 0:
+            for share in _path_shares(pred, t):
+                betweenness += share
+    return betweenness / ((n - 1) * (n - 2))
+
+
+@pr.profiled()
+def sampled_ego_betweenness(succ, pred, n, eps=0.05, deadline=None, rng=None, min_samples=32, batch_size=16):
+    """ Returns the estimated normalized betweenness centrality of local
+    node 0, as ego_betweenness but searching from randomly ordered pivot
+    targets until the estimate has a relative standard error of at most
+    eps or the deadline passes. Exact once every target has been searched.
+    Input:
+        succ, pred, n: as for ego_betweenness
+        eps: float relative standard error target
+        deadline: optional time.perf_counter() value to stop sampling at
+        rng: numpy Generator
+        min_samples: int number of targets searched before stopping early
+        batch_size: int number of targets searched between checks
+    Output:
+        float
+    """
+    if n <= 2 or not succ[0]:
+        return 0.0
+    rng = rng or np.random.default_rng(0)
+    targets = sorted(_reached_from(succ, 0) - {0})
+    order = rng.permutation(len(targets))
+    total, total_sq, k = 0.0, 0.0, 0
+    while k < len(targets):
+        for i in order[k:k + batch_size]:
+            share = sum(_path_shares(pred, targets[i]))
+            total += share
+            total_sq += share * share
+        k = min(k + batch_size, len(targets))
+        if k >= min_samples and k < len(targets) and (
+                _within_error(total, total_sq, k, len(targets), eps) or
+                (deadline is not None and time.perf_counter() > deadline)):
+            break
+    pr.annotate(targets=len(targets), sampled_targets=k)
+    return total * len(targets) / k / ((n - 1) * (n - 2))
+
+
+@pr.profiled()
+def local_structure(indptr, indices, approx=False, eps=0.05, time_budget=None, seed=0):
+    """ Returns the triad census and centrality of local node 0 in the
+    reverse ego graph described by CSR out-adjacency arrays, as built by
+    ego_adjacency. Triads containing node 0 are classified from the
+    reciprocity of each rater and the ratings among raters, and the rest
+    are counted on the raters' subgraph, so no node triples are enumerated.
+    With approx, the raters' census and the betweenness are estimated by
+    sampled_census and sampled_ego_betweenness; the triads containing
+    node 0, the clustering and the degrees stay exact.
+    Input:
+        indptr: array of row offsets into indices
+        indices: array of local successor ids
+        approx: bool, estimate instead of counting
+        eps: float relative standard error target of the estimates
+        time_budget: optional seconds, half spent on the census estimate
+        seed: int seed of the sampling order
+    Output:
+        node_census: dict keyed on TRIAD_NAMES
+        cluster_coef: float directed clustering coefficient of node 0
+        neighbors_in: int number of raters of node 0, not counting a self
+                      rating, which ego_adjacency leaves out
+        betweeness: float normalized betweenness centrality of node 0
+        excess_ratings_in: float in minus out degree centrality of node 0
+    """
+    n = len(indptr) - 1
+    succ = [set(indices[indptr[i]:indptr[i + 1]].tolist()) for i in range(n)]
+    pred = [set() for _ in range(n)]
+    for v in range(n):
+        for w in succ[v]:
+            pred[w].add(v)
+    raters = list(range(1, n))
+    recip = succ[0]
+    if approx:
+        rng = np.random.default_rng(seed)
+        start = time.perf_counter()
+        deadline = None if time_budget is None else start + time_budget / 2
+        census = sampled_census(succ, pred, raters, eps, deadline, rng)
+    else:
+        census = local_census(succ, pred, raters)
+
+    # triads joining node 0 with two of its raters
+    connected = {}
+    for v in raters:
+        for w in succ[v] | pred[v]:
+            if v < w:
+                idx = _tricode(succ, 0, v, w)
+                census[idx] += 1
+                key = (v in recip) + (w in recip)
+                connected[key] = connected.get(key, 0) + 1
+    n_recip = len(recip)
+    n_single = len(raters) - n_recip
+    pairs = {2: n_recip * (n_recip - 1) // 2,
+             1: n_recip * n_single,
+             0: n_single * (n_single - 1) // 2}
+    # unlinked rater pairs: both rate node 0, which rates back `key` of them
+    for key, code in ((0, 2 + 8), (1, 1 + 2 + 8), (2, 1 + 2 + 4 + 8)):
+        census[TRICODES[code] - 1] += pairs[key] - connected.get(key, 0)
+
+    # directed triangles through node 0 as counted by networkx.clustering
+    triangles = 0
+    for j in raters:
+        jpreds = pred[j] - {0}
+        jsuccs = succ[j] - {0}
+        count = len(jpreds) + len(jsuccs) + len(recip & jpreds) + len(recip & jsuccs)
+        triangles += count * (2 if j in recip else 1)
+    dtotal = len(raters) + n_recip
+    cluster_coef = 0 if triangles == 0 else triangles / ((dtotal * (dtotal - 1) - 2 * n_recip) * 2)
+
+    scale = 1.0 / (n - 1) if n > 1 else 1.0
+    excess_ratings_in = len(raters) * scale - n_recip * scale
+    if approx:
+        deadline = None if time_budget is None else start + time_budget
+        betweeness = sampled_ego_betweenness(succ, pred, n, eps, deadline, rng)
+    else:
+        betweeness = ego_betweenness(succ, pred, n)
+    node_census = dict(zip(TRIAD_NAMES, census))
+    return (node_census,
+            cluster_coef,
+            len(raters),
+            betweeness,
+            excess_ratings_in)
@@ -0,0 +1,306 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import recall_score, precision_score, f1_score
+from sklearn.model_selection import ParameterGrid, ParameterSampler
+import features as f
+import jobs as j
+
+MERGE_COLS = ['ratee', 'rater', 'date', 'rating']
+SCORES = {'recall': recall_score, 'precision': precision_score, 'f1': f1_score}
+
+# Search spaces of the Model-Tuning notebook. 'auto' meant 'sqrt' for
+# classifiers and was removed from scikit-learn, and min_samples_split
+# must be at least 2, so both are dropped from the grids.
+RANDOM_GRID = {'n_estimators': [int(x) for x in np.linspace(start=200, stop=2000, num=10)],
+               'max_features': ['sqrt'],
+               'max_depth': [int(x) for x in np.linspace(10, 110, num=11)] + [None],
+               'min_samples_split': [2, 5, 10],
+               'min_samples_leaf': [1, 2, 4]}
+PARAM_GRID = {'bootstrap': [True],
+              'max_depth': [35, 40, 45],
+              'max_features': [4, 5],
+              'min_samples_leaf': [1, 2],
+              'min_samples_split': [2, 3],
+              'n_estimators': [1800, 2000, 2200]}
+
+# feature matrix and labels of a worker process, attached once per worker
+_worker_data = None
+
+
+def subset_mask(df_historical, subset='fraud'):
+    """ Returns boolean array of the ratings kept for modeling, as the
+    subset_mask of the Model-Tuning notebook.
+    Input:
+        df_historical: dataframe of historical target features
+        subset: string (fraud/suspicious/all/none)
+    """
+    established = ((df_historical['num_neg_received'] == 0) &
+                   (df_historical['num_pos_received'] >= 3)).to_numpy()
+    rating = df_historical['rating'].to_numpy()
+    if subset == 'fraud':
+        return established & ((rating > 0) | (rating == -10))
+    elif subset == 'suspicious':
+        return established & (rating > -10)
+    elif subset == 'all':
+        return established
+    return np.ones(len(df_historical), dtype=bool)
+
+
+def _read_features(data_dir, job_dir, feature_type):
+    if job_dir is not None:
+        return j.read_feature_store(job_dir, feature_type)
+    return pd.read_csv(os.path.join(data_dir, f'{feature_type}_features.csv'), parse_dates=['date'])
+
+
+def load_feature_frame(data_dir='../data', job_dir=None, subset='fraud'):
+    """ Returns dataframe of the modeling ratings with their historical
+    and model ready graph features, sorted by date. The feature files are
+    aligned on row position, as every pass writes the ratings in the same
+    order, instead of being merged on the rating columns.
+    Input:
+        data_dir: directory of the feature csv files written by features.py
+        job_dir: optional feature job directory of jobs.py to read instead
+        subset: string (fraud/suspicious/all/none), see subset_mask
+    """
+    df_ht = _read_features(data_dir, job_dir, 'historical_target')
+    df_hs = _read_features(data_dir, job_dir, 'historical_source')
+    graph_file = os.path.join(data_dir, 'graph_features.csv')
+    if job_dir is None and os.path.exists(graph_file):
+        df_gg = pd.read_csv(graph_file, parse_dates=['date'])
+    else:
+        df_gt = _read_features(data_dir, job_dir, 'graph_target')
+        df_gs = _read_features(data_dir, job_dir, 'graph_source')
+        df_gg = f.graph_feature_stage(pd.concat([df_gt.reset_index(drop=True),
+                                                 df_gs[f.GRAPH_SOURCE_FEATURES].reset_index(drop=True)],
+                                                axis=1))
+    frames = [df.reset_index(drop=True) for df in (df_ht, df_hs, df_gg)]
+    for df in frames[1:]:
+        if len(df) != len(frames[0]) or not df[MERGE_COLS].equals(frames[0][MERGE_COLS]):
+            raise ValueError("Feature files hold different ratings, regenerate them from the same data")
+
+    mask = subset_mask(frames[0], subset)
+    feature_cols = [[col for col in df.columns if col not in MERGE_COLS + ['color', 'penwidth']]
+                    for df in frames]
+    df_all = pd.concat([frames[0][MERGE_COLS]] + [df[cols] for df, cols in zip(frames, feature_cols)],
+                       axis=1)[mask]
+    return df_all.sort_values('date', kind='stable').reset_index(drop=True)
+
+
+def feature_matrix(df_all):
+    """ Returns (X, y, dates, feature names) of a frame from
+    load_feature_frame: X is a C-contiguous float32 matrix of the features
+    and y marks the negative ratings, as in the notebook.
+    """
+    feature_names = [col for col in df_all.columns if col not in MERGE_COLS]
+    X = np.ascontiguousarray(df_all[feature_names].to_numpy(dtype=np.float32))
+    y = (df_all['rating'].to_numpy() < 0).astype(np.int8)
+    return X, y, df_all['date'].to_numpy(), feature_names
+
+
+def time_series_splits(dates, n_splits=3):
+    """ Returns list of (test_start, test_stop) row positions of expanding
+    window splits of date-sorted rows: each fold trains on every row before
+    test_start and tests on the block up to test_stop. Blocks hold roughly
+    equal row counts and are cut on timestamp boundaries, so ratings
+    sharing a date are never split between train and test.
+    Input:
+        dates: sorted array of rating dates
+        n_splits: int number of folds
+    """
+    cuts = np.linspace(0, len(dates), n_splits + 2).astype(int)[1:-1]
+    # move each cut forward to the first row of its timestamp
+    cuts = np.unique(np.searchsorted(dates, dates[cuts], side='left'))
+    cuts = cuts[cuts > 0]
+    bounds = list(cuts) + [len(dates)]
+    return [(int(start), int(stop)) for start, stop in zip(bounds, bounds[1:])]
+
+
+def data_fingerprint(X, y, splits):
+    """ Returns sha1 hex digest of the feature matrix, labels and splits. """
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(X).tobytes())
+    digest.update(np.ascontiguousarray(y).tobytes())
+    digest.update(json.dumps(splits).encode())
+    return digest.hexdigest()
+
+
+def param_hash(params, fold, fingerprint, random_state=123):
+    """ Returns sha1 hex digest keying one fitted fold in the cache. """
+    key = {'model': 'RandomForestClassifier', 'params': params, 'fold': list(fold),
+           'data': fingerprint, 'random_state': random_state}
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def grid_candidates(param_grid):
+    """ Returns list of every parameter combination of a grid. """
+    return list(ParameterGrid(param_grid))
+
+
+def random_candidates(param_distributions, n_iter, random_state=123):
+    """ Returns list of n_iter parameter combinations sampled without
+    replacement. For grids of lists the sample is a prefix of one fixed
+    permutation, so raising n_iter only adds candidates to the search.
+    """
+    if all(isinstance(v, (list, tuple)) for v in param_distributions.values()):
+        grid = ParameterGrid(param_distributions)
+        order = np.random.RandomState(random_state).permutation(len(grid))
+        return [grid[int(i)] for i in order[:n_iter]]
+    return list(ParameterSampler(param_distributions, n_iter, random_state=random_state))
+
+
+def _share(arr):
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, arr.dtype, buffer=shm.buf)[:] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def _attach(spec):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype, buffer=shm.buf)
+
+
+def _init_worker(x_spec, y_spec):
+    global _worker_data
+    shm_x, X = _attach(x_spec)
+    shm_y, y = _attach(y_spec)
+    _worker_data = (shm_x, shm_y, X, y)
+
+
+def fit_fold(X, y, params, fold, random_state=123, keep_model=False):
+    """ Returns dict of the test scores and fit seconds of a random forest
+    fit on one time ordered fold, with the fitted model if keep_model.
+    """
+    test_start, test_stop = fold
+    model = RandomForestClassifier(random_state=random_state, n_jobs=1, **params)
+    start = time.perf_counter()
+    model.fit(X[:test_start], y[:test_start])
+    fit_s = time.perf_counter() - start
+    y_true = y[test_start:test_stop]
+    y_pred = model.predict(X[test_start:test_stop])
+    result = {name: score(y_true, y_pred, zero_division=0) for name, score in SCORES.items()}
+    result.update(fit_s=fit_s, n_train=test_start, n_test=test_stop - test_start)
+    if keep_model:
+        result['model'] = model
+    return result
+
+
+def _fit_task(params, fold, random_state, keep_model, filename):
+    _, _, X, y = _worker_data
+    result = fit_fold(X, y, params, fold, random_state, keep_model)
+    pd.to_pickle(result, filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
+    return result
+
+
+def run_search(X, y, dates, candidates, n_splits=3, n_workers=None, cache_dir='../data/tuning_cache',
+               scoring='recall', random_state=123, keep_models=False):
+    """ Returns dataframe of the mean and std of the test scores of every
+    candidate over time ordered folds, ranked by the scoring metric.
+    (candidate, fold) fits are fanned out across processes that read X and
+    y from shared memory, and each fitted fold is cached in cache_dir under
+    the hash of its parameters, fold and data, so running a larger search
+    later only fits the new candidates.
+    Input:
+        X, y, dates: outputs of feature_matrix
+        candidates: list of parameter dicts of RandomForestClassifier
+        n_splits: int number of folds, see time_series_splits
+        n_workers: number of processes, defaults to os.cpu_count()
+        cache_dir: directory of the fold cache
+        scoring: string (recall/precision/f1) used to rank candidates
+        random_state: int seed of every forest
+        keep_models: also cache the fitted forests
+    """
+    if scoring not in SCORES:
+        raise ValueError(f"Invalid scoring. Use: {'/'.join(SCORES)}")
+    os.makedirs(cache_dir, exist_ok=True)
+    splits = time_series_splits(dates, n_splits)
+    fingerprint = data_fingerprint(X, y, splits)
+
+    results, pending = {}, []
+    for i, params in enumerate(candidates):
+        for k, fold in enumerate(splits):
+            filename = os.path.join(cache_dir, param_hash(params, fold, fingerprint, random_state) + '.pkl')
+            if os.path.exists(filename):
+                results[i, k] = dict(pd.read_pickle(filename), cached=True)
+            else:
+                pending.append((i, k, params, fold, filename))
+
+    if pending:
+        shm_x, x_spec = _share(np.ascontiguousarray(X, dtype=np.float32))
+        shm_y, y_spec = _share(np.ascontiguousarray(y))
+        try:
+            with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count(), initializer=_init_worker,
+                                     initargs=(x_spec, y_spec)) as executor:
+                futures = {executor.submit(_fit_task, params, fold, random_state, keep_models,
+                                           filename): (i, k)
+                           for i, k, params, fold, filename in pending}
+                for future, key in futures.items():
+                    results[key] = dict(future.result(), cached=False)
+        finally:
+            for shm in (shm_x, shm_y):
+                shm.close()
+                shm.unlink()
+
+    records = []
+    for i, params in enumerate(candidates):
+        folds = [results[i, k] for k in range(len(splits))]
+        record = {'params': params}
+        record.update({f'param_{name}': value for name, value in params.items()})
+        for name in SCORES:
+            scores = [fold[name] for fold in folds]
+            record[f'mean_test_{name}'] = np.mean(scores)
+            record[f'std_test_{name}'] = np.std(scores)
+        record['mean_fit_s'] = np.mean([fold['fit_s'] for fold in folds])
+        record['cached_folds'] = sum(fold['cached'] for fold in folds)
+        records.append(record)
+    df_results = pd.DataFrame(records)
+    df_results[f'rank_test_{scoring}'] = (df_results[f'mean_test_{scoring}']
+                                          .rank(ascending=False, method='min').astype(int))
+    return df_results.sort_values(f'rank_test_{scoring}', kind='stable').reset_index(drop=True)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Tune the random forest over time ordered folds of the feature files.')
+    parser.add_argument('--data-dir', default='../data')
+    parser.add_argument('--job-dir', help='read the features of a jobs.py feature job instead of the csv files')
+    parser.add_argument('--subset', default='fraud', choices=['fraud', 'suspicious', 'all', 'none'])
+    parser.add_argument('--search', default='random', choices=['random', 'grid'])
+    parser.add_argument('--n-iter', type=int, default=100, help='candidates of a random search')
+    parser.add_argument('--grid', help='json file of the parameter grid, defaults to the notebook grids')
+    parser.add_argument('--splits', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--cache-dir', default='../data/tuning_cache')
+    parser.add_argument('--scoring', default='recall', choices=list(SCORES))
+    parser.add_argument('--keep-models', action='store_true')
+    parser.add_argument('--output', default='../data/tuning_results.csv')
+    args = parser.parse_args()
+
+    if args.grid:
+        with open(args.grid) as fh:
+            grid = json.load(fh)
+    else:
+        grid = RANDOM_GRID if args.search == 'random' else PARAM_GRID
+    if args.search == 'random':
+        candidates = random_candidates(grid, args.n_iter)
+    else:
+        candidates = grid_candidates(grid)
+
+    X, y, dates, feature_names = feature_matrix(load_feature_frame(args.data_dir, args.job_dir, args.subset))
+    print(f"{X.shape[0]} ratings, {X.shape[1]} features, {y.mean():.3f} negative")
+    start_time = time.time()
+    df_results = run_search(X, y, dates, candidates, args.splits, args.workers, args.cache_dir,
+                            args.scoring, keep_models=args.keep_models)
+    print(f"{(time.time() - start_time):.0f} seconds execution time")
+    df_results.to_csv(args.output, index=False)
+    print(df_results.drop(columns='params').head(10).to_string(index=False))
@@ -5,36 +5,48 @@ import itertools
 import matplotlib.pyplot as plt
 plt.style.use('ggplot')
 
-import networkx as nx
 import nxpd
 import helpers as h
 
-def plot_timeline(bitcoin_df, title):
+def plot_timeline(bitcoin_df, title, counts=None, ax=None):
     """ Plots positive and negative user rating counts over time
     Inputs:
         df: dataframe containg fields rating and date
         title: plot title
+        counts: optional dataframe of weekly positive and negative counts,
+                e.g. from investigation.timeline_counts, plotted instead of
+                counting bitcoin_df (which may then be None)
+        ax: optional matplotlib axes, a new figure is made by default
     """
-    timeline = bitcoin_df.copy()
-    timeline.set_index(pd.DatetimeIndex(timeline.date), inplace=True)
+    if counts is None:
+        # count the rating signs per week without copying the ratings
+        negative = bitcoin_df['rating'].values < 0
+        counts = pd.DataFrame({'positive': ~negative, 'negative': negative},
+                              index=pd.DatetimeIndex(bitcoin_df['date'].values)).resample("W").sum()
 
-    fig, ax = plt.subplots(figsize=(15,4))
-    ax.plot(timeline[timeline['rating'] >= 0]["rating"].resample("w").count(), c="b",label="Positive Ratings Count")
-    ax.plot(timeline[timeline['rating'] < 0]["rating"].resample("w").count(), c="r",label="Negative Ratings Count")
+    if ax is None:
+        fig, ax = plt.subplots(figsize=(15,4))
+    ax.plot(counts['positive'], c="b",label="Positive Ratings Count")
+    ax.plot(counts['negative'], c="r",label="Negative Ratings Count")
     ax.legend()
     ax.set_title(title)
     plt.tight_layout()
 
-def add_user_to_graph(existing_graph, new_user, bitcoin_df):
+def add_user_to_graph(existing_graph, new_user, bitcoin_df, index=None):
     """ Returns a new graph object that now also includes the user's
     given and received ratings.
     Input: 
         existing_graph: graph object
         new_user: int
-        bitcoin_g: graph containing new user node
+        bitcoin_df: dataframe of bitcoin ratings, may be None with an index
+        index: optional helpers.RatingIndex of bitcoin_df, to slice out the
+               user's ratings instead of scanning bitcoin_df
     """
-    # return nx.compose(existing_graph, nx.ego_graph(bitcoin_g, new_user, radius=1))
-    return nx.compose(existing_graph, user_graph(new_user, bitcoin_df))
+    user_df = h.user_data(bitcoin_df, new_user, user_type='all', rating_type='all', index=index)
+    attrs = user_df.drop(columns=['rater', 'ratee']).to_dict('records')
+    graph = existing_graph.copy()
+    graph.add_edges_from(zip(user_df['rater'].tolist(), user_df['ratee'].tolist(), attrs))
+    return graph
 
 def confusion_pct(cm):
     """ Returns a confusion matrix array containing 